@@ -0,0 +1,179 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import scipy.sparse as sparse
+from sqlalchemy import BigInteger
+from sqlalchemy.sql import cast, func, select
+from .utils import SQL_IN_BATCH_SIZE
+from .models.annotation import annotation_key_set_annotation_key_association as ks_assoc
+from .models.candidate import candidate_set_candidate_association as cs_assoc
+
+CACHED_ARRAYS = ['data', 'indices', 'indptr', 'cids', 'kids']
+
+# Modulus of the sum of squares of the ids in the membership digest of a set; small enough that the sum fits into
+# a 64-bit integer for any realistic set size
+MEMBERSHIP_MODULUS = 2147483647
+
+
+class AnnotationMatrixCache(object):
+    """
+    An on-disk cache of sparse annotation matrices, keyed by (CandidateSet, AnnotationKeySet) for a single
+    annotation class, e.g. Label or Feature.
+
+    Each entry is a directory of raw .npy arrays--the CSR data, indices and indptr, plus the sorted candidate and
+    key ids defining the row and column index maps--which are memory-mapped on load. Entries are invalidated by a
+    cheap fingerprint of the database: the size, max id and a digest of the ids of the members of each set (see
+    _membership_stat), and a version counter per AnnotationKeySet, which AnnotationManager bumps for all key sets
+    containing the keys written both before writing annotations and after committing them (see
+    bump_versions_for_keys).
+
+    NOTE: Annotations written by other means than AnnotationManager.update, or by a manager not using this cache,
+    are not detected; call clear() in this case.
+    """
+    def __init__(self, cache_dir, annotation_cls):
+        self.annotation_cls = annotation_cls
+        self.cache_dir      = os.path.join(cache_dir, annotation_cls.__table__.name)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _entry_dir(self, candidate_set, key_set):
+        return os.path.join(self.cache_dir, 'candidate_set_%s_key_set_%s' % (candidate_set.id, key_set.id))
+
+    def _version_path(self, key_set_id):
+        return os.path.join(self.cache_dir, 'key_set_%s.version' % key_set_id)
+
+    def _get_version(self, key_set_id):
+        try:
+            with open(self._version_path(key_set_id)) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return 0
+
+    def _bump_version(self, key_set_id):
+        version = self._get_version(key_set_id) + 1
+        with open(self._version_path(key_set_id), 'w') as f:
+            f.write(str(version))
+        return version
+
+    def get_version(self, key_set):
+        """Returns the version counter of the AnnotationKeySet"""
+        return self._get_version(key_set.id)
+
+    def bump_version(self, key_set):
+        """Increments the version counter of the AnnotationKeySet, invalidating all entries which use it"""
+        return self._bump_version(key_set.id)
+
+    def bump_versions_for_keys(self, session, key_ids):
+        """
+        Increments the version counters of all AnnotationKeySets containing any of the AnnotationKeys with ids
+        key_ids, i.e. of all those whose entries annotations with these keys may be part of
+        """
+        key_ids     = list(key_ids)
+        key_set_ids = set()
+        for i in range(0, len(key_ids), SQL_IN_BATCH_SIZE):
+            q = select([ks_assoc.c.annotation_key_set_id]).distinct()
+            q = q.where(ks_assoc.c.annotation_key_id.in_(key_ids[i:i+SQL_IN_BATCH_SIZE]))
+            key_set_ids.update(ksid for ksid, in session.execute(q))
+        for key_set_id in key_set_ids:
+            self._bump_version(key_set_id)
+
+    def _membership_stat(self, session, id_col, where):
+        """
+        Returns the size, max id and an order-independent digest of the ids--their sum, and sum of squares modulo
+        MEMBERSHIP_MODULUS--of the members of a set, so that changes of its members are detected even if they
+        leave its size and max id unchanged
+        """
+        ids = cast(id_col, BigInteger)
+        q   = select([func.count(), func.max(ids), func.sum(ids), func.sum((ids * ids) % MEMBERSHIP_MODULUS)])
+        return [int(x) if x is not None else None for x in session.execute(q.where(where)).first()]
+
+    def _candidate_set_stat(self, session, candidate_set):
+        """Returns the membership stat of the CandidateSet (see _membership_stat)"""
+        return self._membership_stat(session, cs_assoc.c.candidate_id,
+                                     cs_assoc.c.candidate_set_id == candidate_set.id)
+
+    def fingerprint(self, session, candidate_set, key_set):
+        """Returns a JSON-serializable fingerprint of the DB state an entry for these sets is computed from"""
+        ks_stat = self._membership_stat(session, ks_assoc.c.annotation_key_id,
+                                        ks_assoc.c.annotation_key_set_id == key_set.id)
+        return [candidate_set.name, self._candidate_set_stat(session, candidate_set), key_set.name, ks_stat,
+                self.get_version(key_set)]
+
+    def get(self, candidate_set, key_set, fingerprint, ignore_candidate_set=False):
+        """
+        Returns the cached (X, cids, kids) for the sets, where X is a CSR matrix backed by memory-mapped arrays,
+        or None if there is no entry matching the fingerprint.
+
+        If ignore_candidate_set is True, the entry only has to match the fingerprint other than the membership stat
+        of the candidate set, i.e. the candidates of its rows may since have been added to or removed from the set.
+        """
+        entry_dir = self._entry_dir(candidate_set, key_set)
+        try:
+            with open(os.path.join(entry_dir, 'fingerprint.json')) as f:
+                entry_fingerprint = json.load(f)
+            if ignore_candidate_set:
+                entry_fingerprint, fingerprint = entry_fingerprint[:1] + entry_fingerprint[2:], \
+                                                 fingerprint[:1] + fingerprint[2:]
+            if entry_fingerprint != fingerprint:
+                return None
+            arrays = dict((a, np.load(os.path.join(entry_dir, a + '.npy'), mmap_mode='c')) for a in CACHED_ARRAYS)
+        except (IOError, ValueError):
+            return None
+        cids, kids = arrays['cids'], arrays['kids']
+        X = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=(len(cids), len(kids)),
+                              copy=False)
+        return X, cids, kids
+
+    def put(self, candidate_set, key_set, fingerprint, X, cids, kids):
+        """Stores (X, cids, kids) for the sets, replacing any existing entry"""
+        X = sparse.csr_matrix(X)
+        arrays = {'data': X.data, 'indices': X.indices, 'indptr': X.indptr, 'cids': cids, 'kids': kids}
+
+        # Write to a temporary directory first, so that entries are never read partially written
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir)
+        for a in CACHED_ARRAYS:
+            np.save(os.path.join(tmp_dir, a + '.npy'), np.asarray(arrays[a]))
+        with open(os.path.join(tmp_dir, 'fingerprint.json'), 'w') as f:
+            json.dump(fingerprint, f)
+        entry_dir = self._entry_dir(candidate_set, key_set)
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.rename(tmp_dir, entry_dir)
+
+    def _functions_path(self, candidate_set, key_set):
+        return os.path.join(self.cache_dir, 'candidate_set_%s_key_set_%s.functions.json' % (candidate_set.id, key_set.id))
+
+    def get_functions(self, session, candidate_set, key_set, check_candidate_set=True):
+        """
+        Returns a dict mapping the names of the annotation functions last applied to the CandidateSet for the
+        AnnotationKeySet to their fingerprints (see annotations.function_fingerprint); empty if there are none,
+        or, if check_candidate_set is True, if candidates have been added to or removed from the CandidateSet since.
+        """
+        try:
+            with open(self._functions_path(candidate_set, key_set)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if check_candidate_set and entry['candidate_set'] != self._candidate_set_stat(session, candidate_set):
+            return {}
+        return entry['functions']
+
+    def put_functions(self, session, candidate_set, key_set, functions):
+        """Records the dict functions, mapping names of annotation functions just applied to their fingerprints"""
+        entry = {
+            'candidate_set' : self._candidate_set_stat(session, candidate_set),
+            'functions'     : self.get_functions(session, candidate_set, key_set)
+        }
+        entry['functions'].update(functions)
+        path = self._functions_path(candidate_set, key_set)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_path, path)
+
+    def clear(self):
+        """Removes all entries and version counters"""
+        shutil.rmtree(self.cache_dir)
+        os.makedirs(self.cache_dir)
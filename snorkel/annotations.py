@@ -1,13 +1,33 @@
+from collections import OrderedDict
+from cStringIO import StringIO
+import cPickle
+import hashlib
+from multiprocessing import Process, Queue
+import numpy as np
 from pandas import DataFrame, Series
 import scipy.sparse as sparse
-from sqlalchemy.sql import bindparam, func, select
+import types
+from sqlalchemy.sql import and_, bindparam, func, select
+from . import SnorkelSession
 from .utils import matrix_conflicts, matrix_coverage, matrix_overlaps
-from .models import Label, Feature, AnnotationKey, AnnotationKeySet, Candidate, CandidateSet
+from .models import Label, Feature, AnnotationKey, AnnotationKeySet, Candidate, CandidateSet, load_candidates
+from .models import snorkel_postgres
 from .models.annotation import annotation_key_set_annotation_key_association as assoc_table
-from .utils import get_ORM_instance, ProgressBar
+from .models.candidate import candidate_set_candidate_association as cs_assoc
+from .utils import collect_worker_results, get_ORM_instance, ProgressBar, run_worker, SQL_IN_BATCH_SIZE, start_workers
+from .annotation_cache import AnnotationMatrixCache
 from .features import get_span_feats
 from sqlalchemy.orm.session import object_session
 
+# Number of annotations generated in memory before being written to the DB in bulk
+ANNOTATION_BATCH_SIZE = 100000
+
+# Number of candidates, by contiguous id range, per shard handed to an AnnotationProcess
+ANNOTATION_SHARD_SIZE = 1000
+
+# Number of annotation rows fetched from the DB at a time when loading a sparse matrix
+LOAD_BATCH_SIZE = 100000
+
 
 class csr_AnnotationMatrix(sparse.csr_matrix):
     """
@@ -71,15 +91,18 @@ class AnnotationManager(object):
         * Feature
         * Label
     E.g. for features, LF labels, human annotator labels, etc.
+
+    If cache_dir is provided, loaded sparse matrices are cached on disk there (see AnnotationMatrixCache).
     """
-    def __init__(self, annotation_cls, matrix_cls=csr_AnnotationMatrix, default_f=None):
+    def __init__(self, annotation_cls, matrix_cls=csr_AnnotationMatrix, default_f=None, cache_dir=None):
         self.annotation_cls = annotation_cls
         if not issubclass(matrix_cls, csr_AnnotationMatrix):
             raise ValueError('matrix_cls must be a subclass of csr_AnnotationMatrix')
         self.matrix_cls = matrix_cls
         self.default_f = default_f
+        self.cache = AnnotationMatrixCache(cache_dir, annotation_cls) if cache_dir is not None else None
     
-    def create(self, session, candidate_set, new_key_set, f=None):
+    def create(self, session, candidate_set, new_key_set, f=None, parallelism=1):
         """
         Generates annotations for candidates in a candidate set, and persists these to the database,
         as well as returning a sparse matrix representation.
@@ -96,6 +119,8 @@ class AnnotationManager(object):
 
             * A list of functions, each of which maps from candidates to values; by default, the key_name
                 is the function.__name__.  Ex: A list of labeling functions
+
+        :param parallelism: Number of worker processes to annotate the candidates with (see update)
         """
         candidate_set = get_ORM_instance(CandidateSet, session, candidate_set)
         existing_key_set = session.query(AnnotationKeySet).filter(AnnotationKeySet.name == new_key_set).first()
@@ -106,9 +131,10 @@ class AnnotationManager(object):
         session.add(key_set)
         session.commit()
 
-        return self.update(session, candidate_set, key_set, True, f)
+        return self.update(session, candidate_set, key_set, True, f, parallelism=parallelism)
     
-    def update(self, session, candidate_set, key_set, expand_key_set, f=None):
+    def update(self, session, candidate_set, key_set, expand_key_set, f=None, parallelism=1, incremental=False,
+               new_candidates_only=False):
         """
         Generates annotations for candidates in a candidate set and *adds* them to an existing annotation set,
         also adding the respective keys to the key set; returns a sparse matrix representation of the full
@@ -129,6 +155,18 @@ class AnnotationManager(object):
 
             * A list of functions, each of which maps from candidates to values; by default, the key_name
                 is the function.__name__.  Ex: A list of labeling functions
+
+        :param parallelism: If greater than 1, the candidates are sharded by id range across this many worker
+        processes, each of which loads its candidates eagerly and applies f to them; the annotations are then
+        merged and persisted by this process, in the same way as when annotating serially
+
+        :param incremental: If True, only the functions in f which are new, or whose fingerprint has changed since
+        they were last applied to the candidate set for the key set (see function_fingerprint), are applied; the
+        resulting columns are spliced into the cached matrix. Requires a cache_dir and f to be a list of functions.
+
+        :param new_candidates_only: If True, only the candidates in the candidate set without any annotations for
+        the key set--e.g. those added to it since it was last annotated--are annotated; their rows are appended to
+        the cached matrix, if any. NOTE: Candidates whose annotations were all zero are annotated again.
         """
         # Prepares arguments
         candidate_set = get_ORM_instance(CandidateSet, session, candidate_set)
@@ -136,65 +174,299 @@ class AnnotationManager(object):
         if f is None:
             f = self.default_f
 
-        # Prepares helpers
-        annotation_generator = _to_annotation_generator(f) if hasattr(f, '__iter__') else f
-        pb = ProgressBar(len(candidate_set))
-
-        # Prepares queries
-        key_select_query = select([AnnotationKey.id]).where(AnnotationKey.name == bindparam('name'))
-
-        key_insert_query = AnnotationKey.__table__.insert()
-
-        assoc_select_query = select([func.count()]).select_from(assoc_table)
-        assoc_select_query = assoc_select_query.where(assoc_table.c.annotation_key_set_id == bindparam('ksid'))
-        assoc_select_query = assoc_select_query.where(assoc_table.c.annotation_key_id == bindparam('kid'))
+        if incremental and new_candidates_only:
+            raise ValueError('Only one of incremental and new_candidates_only can be set.')
+
+        # Fingerprints the functions, so that unchanged ones can be skipped when updating incrementally
+        fns          = list(f) if hasattr(f, '__iter__') else None
+        fingerprints = None
+        if self.cache is not None and fns is not None:
+            fingerprints = dict((fn.__name__, function_fingerprint(fn)) for fn in fns)
+        spliced = None
+        cids_q  = None
+        if incremental:
+            if fingerprints is None:
+                raise ValueError('Incremental updates require a cache_dir, and f to be a list of functions.')
+            applied = self.cache.get_functions(session, candidate_set, key_set)
+            fns     = [fn for fn in fns if applied.get(fn.__name__) != fingerprints[fn.__name__]]
+            print "Applying %s new or changed functions..." % len(fns)
+            if len(fns) == 0:
+                return self.load(session, candidate_set, key_set)
+
+            # The new annotations are kept in memory too, to splice into the cached matrix if it is still valid
+            fingerprint = self.cache.fingerprint(session, candidate_set, key_set)
+            cached      = self.cache.get(candidate_set, key_set, fingerprint)
+            spliced     = OrderedDict() if cached is not None else None
+
+        elif new_candidates_only:
+            cids_q = self._candidate_ids_query(candidate_set, key_set)
+            n_new  = session.execute(select([func.count()]).select_from(cids_q.alias())).scalar()
+            print "Annotating %s new candidates..." % n_new
+            if n_new == 0:
+                return self.load(session, candidate_set, key_set)
+
+            # The new annotations are kept in memory too, to append to the cached matrix if it is otherwise valid
+            if self.cache is not None:
+                applied     = self.cache.get_functions(session, candidate_set, key_set, check_candidate_set=False)
+                fingerprint = self.cache.fingerprint(session, candidate_set, key_set)
+                cached      = self.cache.get(candidate_set, key_set, fingerprint, ignore_candidate_set=True)
+                spliced     = OrderedDict() if cached is not None else None
 
-        assoc_insert_query = assoc_table.insert()
+        # Prepares helpers
+        annotation_generator = _to_annotation_generator(fns) if fns is not None else f
+        if cids_q is None:
+            cids_q = self._candidate_ids_query(candidate_set)
+        if parallelism > 1:
+            annotations = self._annotate_multiprocess(session, candidate_set, cids_q, annotation_generator,
+                                                      parallelism)
+        elif new_candidates_only:
+            annotations = self._annotate(session, candidate_set, annotation_generator, cids_q)
+        else:
+            annotations = self._annotate(session, candidate_set, annotation_generator)
+
+        # Generates annotations for CandidateSet in memory, writing them to the DB in batches
+        # NOTE: Values are keyed by (candidate id, key name) so that, as before, the last value wins, and new
+        # keys are created in the order they are first generated
+        key_ids     = {}
+        key_set_ids = self._get_key_set_ids(session, key_set) if expand_key_set else None
+        batch       = OrderedDict()
+        for cid, key_name, value in annotations:
+            batch[(cid, key_name)] = value
+            if spliced is not None:
+                spliced[(cid, key_name)] = value
+            if len(batch) >= ANNOTATION_BATCH_SIZE:
+                self._persist_annotations(session, key_set, expand_key_set, batch, key_ids, key_set_ids)
+                batch.clear()
+        self._persist_annotations(session, key_set, expand_key_set, batch, key_ids, key_set_ids)
+        session.commit()
+        if self.cache is not None:
+            # The versions were bumped before writing too, but entries cached by loads which read the annotations
+            # since--while they were not yet committed--are only invalidated by bumping them again now
+            self.cache.bump_versions_for_keys(session, key_ids.values())
+            if fingerprints is not None:
+                if new_candidates_only:
+                    # The functions are now applied to all candidates only if they were to all the others before
+                    functions = dict((name, fp) for name, fp in fingerprints.iteritems() if applied.get(name) == fp)
+                else:
+                    functions = dict((fn.__name__, fingerprints[fn.__name__]) for fn in fns)
+                self.cache.put_functions(session, candidate_set, key_set, functions)
+
+        if spliced is not None:
+            print "Splicing into cached sparse %s matrix..." % self.annotation_cls.__name__
+            splice = self._splice_annotations(session, candidate_set, key_set, cached, spliced, key_ids,
+                                              replace_keys=incremental)
+            if splice is not None:
+                X, cids, kids = splice
+                self.cache.put(candidate_set, key_set, self.cache.fingerprint(session, candidate_set, key_set), X,
+                               cids, kids)
+                return self._to_matrix(candidate_set, key_set, X, cids, kids)
 
-        anno_update_query = self.annotation_cls.__table__.update()
-        anno_update_query = anno_update_query.where(self.annotation_cls.candidate_id == bindparam('cid'))
-        anno_update_query = anno_update_query.where(self.annotation_cls.key_id == bindparam('kid'))
-        anno_update_query = anno_update_query.values(value=bindparam('value'))
+        print "Loading sparse %s matrix..." % self.annotation_cls.__name__
+        return self.load(session, candidate_set, key_set)
 
-        anno_insert_query = self.annotation_cls.__table__.insert()
+    def _splice_annotations(self, session, candidate_set, key_set, cached, annotations, key_ids, replace_keys):
+        """
+        Returns the cached (X, cids, kids) with the values in annotations--a dict mapping (candidate id, key name)
+        pairs to values--added, and with rows and columns for any candidates and keys newly added to the sets; or
+        None if candidates have been removed from the candidate set since.
 
-        # Generates annotations for CandidateSet
-        for i, candidate in enumerate(candidate_set):
+        If replace_keys is True, the annotations are of all candidates, and replace the columns of their keys.
+        """
+        X, cids, kids = cached
+        new_cids = _select_ids(session, cs_assoc.c.candidate_id, cs_assoc.c.candidate_set_id, candidate_set.id)
+        new_kids = _select_ids(session, assoc_table.c.annotation_key_id, assoc_table.c.annotation_key_set_id, key_set.id)
+        if not np.in1d(cids, new_cids).all():
+            return None
+
+        # Keep the cached entries, other than those of the replaced keys
+        X      = X.tocoo()
+        X_kids = kids[X.col]
+        if replace_keys:
+            keep = ~np.in1d(X_kids, list(set(key_ids[key_name] for _, key_name in annotations if key_name in key_ids)))
+        else:
+            keep = np.ones(X.nnz, dtype=bool)
+        rows   = [np.searchsorted(new_cids, cids[X.row[keep]])]
+        cols   = [np.searchsorted(new_kids, X_kids[keep])]
+        vals   = [X.data[keep]]
+
+        # Add the new non-zero values of keys in the key set
+        new = np.array([(cid, key_ids[key_name], value) for (cid, key_name), value in annotations.iteritems()
+                        if value != 0 and key_name in key_ids], dtype=np.float64).reshape(-1, 3)
+        new = new[np.in1d(new[:, 1], new_kids)]
+        rows.append(np.searchsorted(new_cids, new[:, 0]))
+        cols.append(np.searchsorted(new_kids, new[:, 1]))
+        vals.append(new[:, 2])
+        X = sparse.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                              shape=(len(new_cids), len(new_kids))).tocsr()
+        return X, new_cids, new_kids
+
+    def _candidate_ids_query(self, candidate_set, key_set=None):
+        """
+        Returns a query for the ids of the candidates in the CandidateSet; if key_set is provided, only of those
+        without any annotations for the AnnotationKeySet
+        """
+        q = select([cs_assoc.c.candidate_id]).where(cs_assoc.c.candidate_set_id == candidate_set.id)
+        if key_set is not None:
+            anno   = self.annotation_cls.__table__
+            ks_ids = select([assoc_table.c.annotation_key_id]).where(assoc_table.c.annotation_key_set_id == key_set.id)
+            q = q.where(~cs_assoc.c.candidate_id.in_(select([anno.c.candidate_id]).where(anno.c.key_id.in_(ks_ids))))
+        return q
+
+    def _annotate(self, session, candidate_set, annotation_generator, cids_q=None):
+        """
+        Yields the (candidate id, key name, value) annotations of the CandidateSet; if cids_q is provided, only of
+        the candidates with ids in this query. Either way, candidates are loaded eagerly, a page at a time.
+        """
+        if cids_q is None:
+            candidates = candidate_set.iter_eager()
+            n          = len(candidate_set)
+        else:
+            cids       = sorted(set(cid for cid, in session.execute(cids_q)))
+            candidates = _iter_candidates(session, cids)
+            n          = len(cids)
+        pb = ProgressBar(n)
+        for i, candidate in enumerate(candidates):
             pb.bar(i)
             for key_name, value in annotation_generator(candidate):
-                # Check if the AnnotationKey already exists, and gets its id
-                key_id = session.execute(key_select_query, {'name': key_name}).first()
-                if key_id is not None:
-                    key_id = key_id[0]
-
-                # If expand_key_set is True, then we will always insert or update the Annotation
-                if expand_key_set:
-
-                    # If key_name does not exist in the database already, creates a new record
-                    if key_id is None:
-                        key_id = session.execute(key_insert_query, {'name': key_name}).inserted_primary_key[0]
-
-                    # Adds the AnnotationKey to the AnnotationKeySet
-                    if session.execute(assoc_select_query, {'ksid': key_set.id, 'kid': key_id}).scalar() == 0:
-                        session.execute(assoc_insert_query, {'annotation_key_set_id': key_set.id, 'annotation_key_id': key_id})
-
-                    # Updates the annotation value
-                    res = session.execute(anno_update_query, {'cid': candidate.id, 'kid': key_id, 'value': value})
-                    if res.rowcount == 0 and value != 0:
-                        session.execute(anno_insert_query, {'candidate_id': candidate.id, 'key_id': key_id, 'value': value})
-
-                # Else, if the key already exists in the database, we just update the annotation value
-                elif key_id is not None:
-                    res = session.execute(anno_update_query, {'cid': candidate.id, 'kid': key_id, 'value': value})
-                    if res.rowcount == 0 and value != 0:
-                        session.execute(anno_insert_query, {'candidate_id': candidate.id, 'key_id': key_id, 'value': value})
+                yield candidate.id, key_name, value
         pb.close()
-        session.commit()
 
-        print "Loading sparse %s matrix..." % self.annotation_cls.__name__
-        return self.load(session, candidate_set, key_set)
+    def _annotate_multiprocess(self, session, candidate_set, cids_q, annotation_generator, parallelism):
+        """
+        Yields the (candidate id, key name, value) annotations of the candidates of the CandidateSet with ids in
+        the query cids_q, generated by parallelism AnnotationProcesses from shards of ANNOTATION_SHARD_SIZE
+        candidates with contiguous ids; shards are yielded in id order, whatever the order in which they are
+        completed.
+        """
+        cids = np.array(sorted(set(cid for cid, in session.execute(cids_q))), dtype=np.int64)
+        if len(cids) == 0:
+            return
+        shards_in = Queue()
+        annos_out = Queue()
+
+        # Fill the in-queue with (index, min id, max id) shards, followed by one stop signal per worker
+        n_shards = 0
+        for i in range(0, len(cids), ANNOTATION_SHARD_SIZE):
+            shard = cids[i:i+ANNOTATION_SHARD_SIZE]
+            shards_in.put((n_shards, int(shard[0]), int(shard[-1])))
+            n_shards += 1
+        for _ in range(parallelism):
+            shards_in.put(None)
+
+        # Start worker Processes
+        ps = [AnnotationProcess(annotation_generator, cids_q, shards_in, annos_out)
+              for _ in range(parallelism)]
+        start_workers(session, ps)
+
+        # Collect the annotations of each shard, holding back those completed ahead of earlier shards
+        pb         = ProgressBar(len(cids))
+        n_done     = 0
+        pending    = {}
+        next_shard = 0
+        try:
+            for shard_index, n_candidates, annotations in collect_worker_results(ps, annos_out, 'AnnotationProcess'):
+                pending[shard_index] = annotations
+                n_done += n_candidates
+                pb.bar(n_done - 1)
+                while next_shard in pending:
+                    for annotation in pending.pop(next_shard):
+                        yield annotation
+                    next_shard += 1
+        finally:
+            pb.close()
+
+    def _get_key_set_ids(self, session, key_set):
+        """Returns the set of AnnotationKey ids currently in the AnnotationKeySet"""
+        q = select([assoc_table.c.annotation_key_id]).where(assoc_table.c.annotation_key_set_id == key_set.id)
+        return set(kid for kid, in session.execute(q))
+
+    def _get_key_ids(self, session, key_names, key_ids, expand_key_set):
+        """
+        Resolves the ids of the AnnotationKeys named in key_names, using and updating the cache key_ids.
+        Names not yet in the cache are looked up with one IN (...) query per SQL_IN_BATCH_SIZE names; if
+        expand_key_set is True, those still missing are then bulk inserted and looked up again.
+        """
+        new_names = [name for name in OrderedDict.fromkeys(key_names) if name not in key_ids]
+        key_ids.update(_select_key_ids(session, new_names))
+        if expand_key_set:
+            missing = [name for name in new_names if name not in key_ids]
+            if len(missing) > 0:
+                session.execute(AnnotationKey.__table__.insert(), [{'name': name} for name in missing])
+                key_ids.update(_select_key_ids(session, missing))
+        return key_ids
+
+    def _persist_annotations(self, session, key_set, expand_key_set, batch, key_ids, key_set_ids):
+        """
+        Writes a batch of annotations, given as a dict mapping (candidate id, key name) pairs to values.
 
-    def load(self, session, candidate_set, key_set):
+        If expand_key_set is True, new AnnotationKeys are created and added to key_set (key_set_ids caches
+        the ids already in it); otherwise, annotations with keys not already in the database are discarded.
+        As with single-row updates, existing annotations are overwritten, and new ones are only inserted if
+        their value is non-zero.
+        """
+        if len(batch) == 0:
+            return
+        self._get_key_ids(session, [key_name for _, key_name in batch], key_ids, expand_key_set)
+
+        # Adds any new AnnotationKeys to the AnnotationKeySet with a single bulk insert
+        if expand_key_set:
+            new_kids = set(key_ids[key_name] for _, key_name in batch) - key_set_ids
+            if len(new_kids) > 0:
+                session.execute(assoc_table.insert(),
+                                [{'annotation_key_set_id': key_set.id, 'annotation_key_id': kid} for kid in new_kids])
+                key_set_ids.update(new_kids)
+
+        # Writes the annotation values, using the upsert strategy of the backend
+        rows = [(cid, key_ids[key_name], value) for (cid, key_name), value in batch.iteritems() if key_name in key_ids]
+        if len(rows) == 0:
+            return
+        if self.cache is not None:
+            self.cache.bump_versions_for_keys(session, set(kid for _, kid, _ in rows))
+        if snorkel_postgres:
+            self._upsert_annotations_postgres(session, rows)
+        else:
+            self._upsert_annotations_sqlite(session, rows)
+
+    def _upsert_annotations_sqlite(self, session, rows):
+        """Upserts (candidate id, key id, value) rows with one executemany per statement type"""
+        table = self.annotation_cls.__table__
+        zeros = [{'cid': cid, 'kid': kid, 'value': value} for cid, kid, value in rows if value == 0]
+        if len(zeros) > 0:
+            update_query = table.update()
+            update_query = update_query.where(self.annotation_cls.candidate_id == bindparam('cid'))
+            update_query = update_query.where(self.annotation_cls.key_id == bindparam('kid'))
+            update_query = update_query.values(value=bindparam('value'))
+            session.execute(update_query, zeros)
+        non_zeros = [{'candidate_id': cid, 'key_id': kid, 'value': value} for cid, kid, value in rows if value != 0]
+        if len(non_zeros) > 0:
+            session.execute(table.insert().prefix_with('OR REPLACE'), non_zeros)
+
+    def _upsert_annotations_postgres(self, session, rows):
+        """Upserts (candidate id, key id, value) rows by COPYing them into a temporary staging table"""
+        table   = self.annotation_cls.__table__.name
+        staging = table + '_staging'
+        fmt     = '%d\t%d\t%r\n' if self.annotation_cls.value.type.python_type is float else '%d\t%d\t%d\n'
+        buf     = StringIO(''.join(fmt % row for row in rows))
+        cursor  = session.connection().connection.cursor()
+        try:
+            # NOTE: The staging table is also dropped on commit, and with the transaction on rollback, so that it
+            # never outlives a failed batch
+            cursor.execute('DROP TABLE IF EXISTS %s' % staging)
+            cursor.execute('CREATE TEMPORARY TABLE %s (LIKE %s) ON COMMIT DROP' % (staging, table))
+            cursor.copy_from(buf, staging, columns=('candidate_id', 'key_id', 'value'))
+            cursor.execute("""
+                UPDATE {t} SET value = s.value FROM {s} s
+                WHERE s.value = 0 AND {t}.candidate_id = s.candidate_id AND {t}.key_id = s.key_id
+            """.format(t=table, s=staging))
+            cursor.execute("""
+                INSERT INTO {t} (candidate_id, key_id, value) SELECT candidate_id, key_id, value FROM {s}
+                WHERE value != 0 ON CONFLICT (candidate_id, key_id) DO UPDATE SET value = EXCLUDED.value
+            """.format(t=table, s=staging))
+            cursor.execute('DROP TABLE %s' % staging)
+        finally:
+            cursor.close()
+
+    def load(self, session, candidate_set, key_set, use_cache=True):
         """
         Returns the annotations corresponding to a CandidateSet with N members and an AnnotationKeySet with M
         distinct keys as an N x M CSR sparse matrix.
@@ -204,71 +476,172 @@ class AnnotationManager(object):
         :param candidate_set: Can either be a CandidateSet instance or the name of one
 
         :param key_set: Can either be an AnnotationKeySet instance or the name of one
+
+        :param use_cache: If True and this manager has a cache_dir, returns the cached matrix if it is still
+        valid, and otherwise caches the loaded one
         """
         candidate_set = get_ORM_instance(CandidateSet, session, candidate_set)
         key_set       = get_ORM_instance(AnnotationKeySet, session, key_set)
 
-        # Create sparse matrix in LIL format for incremental construction
-        X = sparse.lil_matrix((len(candidate_set), len(key_set)))
-
-        # First, we query to construct the row index map
-        cid_to_row = {}
-        row_to_cid = {}
-        q = session.query(Candidate.id).filter(Candidate.sets.contains(candidate_set)).order_by(Candidate.id).yield_per(1000)
-        for cid, in q.all():
-            if cid not in cid_to_row:
-                j = len(cid_to_row)
-
-                # Create both mappings
-                cid_to_row[cid] = j
-                row_to_cid[j]   = cid
-
-        # Second, we query to construct the column index map
-        kid_to_col = {}
-        col_to_kid = {}
-        q = session.query(AnnotationKey.id).filter(AnnotationKey.sets.contains(key_set)).order_by(AnnotationKey.id).yield_per(1000)
-        for kid, in q.all():
-            if kid not in kid_to_col:
-                j = len(kid_to_col)
-
-                # Create both mappings
-                kid_to_col[kid] = j
-                col_to_kid[j]   = kid
-
-        # Construct the query
-        """
-        q = session.query(self.annotation_cls.candidate_id, self.annotation_cls.key_id, self.annotation_cls.value)
-        q = q.join(Candidate, AnnotationKey)
-        q = q.filter(Candidate.sets.contains(candidate_set)).filter(AnnotationKey.sets.contains(key_set))
-        q = q.order_by(self.annotation_cls.candidate_id).yield_per(1000)
-        """
-
-        # NOTE: This is much faster as it allows us to skip the above join (which for some reason is
-        # unreasonably slow) by relying on our symbol tables from above; however this will get slower with
-        # The total number of annotations in DB which is weird behavior...
-        q = session.query(self.annotation_cls.candidate_id, self.annotation_cls.key_id, self.annotation_cls.value)
-        q = q.order_by(self.annotation_cls.candidate_id)
-        
-        # Iteratively construct row index and output sparse matrix
-        for cid, kid, val in q.all():
-            if cid in cid_to_row and kid in kid_to_col:
-                X[cid_to_row[cid], kid_to_col[kid]] = val
-
-        # Return as an AnnotationMatrix
+        # Checks the cache; the fingerprint is computed *before* loading, so that the entry is invalidated by
+        # writes which are concurrent with loading, as update bumps the versions of the key sets after committing
+        cache = self.cache if use_cache else None
+        if cache is not None:
+            fingerprint = cache.fingerprint(session, candidate_set, key_set)
+            cached      = cache.get(candidate_set, key_set, fingerprint)
+            if cached is not None:
+                return self._to_matrix(candidate_set, key_set, *cached)
+
+        # First, we query for the sorted candidate and key ids, which define the row and column index maps
+        cids = _select_ids(session, cs_assoc.c.candidate_id, cs_assoc.c.candidate_set_id, candidate_set.id)
+        kids = _select_ids(session, assoc_table.c.annotation_key_id, assoc_table.c.annotation_key_set_id, key_set.id)
+
+        # Second, we query for only the annotations in the CandidateSet x AnnotationKeySet, pushing the set
+        # membership filters into SQL as semi-joins against the association tables
+        # NOTE: IN (...) rather than a join, so that candidates appended to a set twice are not double-counted
+        anno = self.annotation_cls.__table__
+        cs_ids = select([cs_assoc.c.candidate_id]).where(cs_assoc.c.candidate_set_id == candidate_set.id)
+        ks_ids = select([assoc_table.c.annotation_key_id]).where(assoc_table.c.annotation_key_set_id == key_set.id)
+        where  = and_(anno.c.candidate_id.in_(cs_ids), anno.c.key_id.in_(ks_ids))
+        n      = session.execute(select([func.count()]).select_from(anno).where(where)).scalar()
+
+        # Stream the (candidate_id, key_id, value) triples into preallocated arrays
+        row_cids = np.empty(n, dtype=np.int64)
+        col_kids = np.empty(n, dtype=np.int64)
+        vals     = np.empty(n, dtype=np.float64)
+        res = session.execute(select([anno.c.candidate_id, anno.c.key_id, anno.c.value]).where(where))
+        i = 0
+        while i < n:
+            chunk = res.fetchmany(LOAD_BATCH_SIZE)
+            if len(chunk) == 0:
+                break
+            chunk = np.array(chunk, dtype=np.float64).reshape(-1, 3)
+            j = i + chunk.shape[0]
+            row_cids[i:j], col_kids[i:j], vals[i:j] = chunk[:, 0], chunk[:, 1], chunk[:, 2]
+            i = j
+        res.close()
+
+        # Map ids to rows / columns and construct the sparse matrix directly from COO format
+        X = sparse.coo_matrix((vals[:i], (np.searchsorted(cids, row_cids[:i]), np.searchsorted(kids, col_kids[:i]))),
+                              shape=(len(cids), len(kids))).tocsr()
+
+        if cache is not None:
+            cache.put(candidate_set, key_set, fingerprint, X, cids, kids)
+        return self._to_matrix(candidate_set, key_set, X, cids, kids)
+
+    def _to_matrix(self, candidate_set, key_set, X, cids, kids):
+        """Returns X as an AnnotationMatrix, with rows indexed by the sorted cids and columns by the sorted kids"""
+        cid_to_row = dict(zip(cids.tolist(), xrange(len(cids))))
+        row_to_cid = dict(enumerate(cids.tolist()))
+        kid_to_col = dict(zip(kids.tolist(), xrange(len(kids))))
+        col_to_kid = dict(enumerate(kids.tolist()))
         return self.matrix_cls(X, candidate_set=candidate_set, candidate_index=cid_to_row, row_index=row_to_cid,
                                key_set=key_set, key_index=kid_to_col, col_index=col_to_kid)
 
 
 class LabelManager(AnnotationManager):
     """Apply labeling functions to the candidates, generating Label annotations"""
-    def __init__(self):
-        super(LabelManager, self).__init__(Label, matrix_cls=csr_LabelMatrix)
+    def __init__(self, cache_dir=None):
+        super(LabelManager, self).__init__(Label, matrix_cls=csr_LabelMatrix, cache_dir=cache_dir)
 
         
 class FeatureManager(AnnotationManager):
     """Apply feature generators to the candidates, generating Feature annotations"""
-    def __init__(self):
-        super(FeatureManager, self).__init__(Feature, default_f=get_span_feats)
+    def __init__(self, cache_dir=None):
+        super(FeatureManager, self).__init__(Feature, default_f=get_span_feats, cache_dir=cache_dir)
+
+
+class AnnotationProcess(Process):
+    """
+    Worker process for AnnotationManager which opens its own SnorkelSession, takes (index, min id, max id) shards
+    of the candidate ids in the query cids_q from shards_in, and loads the candidates in each, along with their
+    arguments and their parents, in a fixed number of queries (see load_candidates). Puts the annotations of each
+    shard on annos_out as a tuple (index, number of candidates, list of (candidate id, key name, value)
+    triplets). Puts None when done, or the traceback string on error.
+    """
+    def __init__(self, annotation_generator, cids_q, shards_in, annos_out):
+        Process.__init__(self)
+        self.annotation_generator = annotation_generator
+        self.cids_q               = cids_q
+        self.shards_in            = shards_in
+        self.annos_out            = annos_out
+
+    def run(self):
+        run_worker(SnorkelSession(), self.shards_in, self.annos_out, self._annotate_shard)
+
+    def _annotate_shard(self, session, shard):
+        index, min_id, max_id = shard
+        cid  = cs_assoc.c.candidate_id
+        q    = self.cids_q.where(cid >= min_id).where(cid <= max_id)
+        cids = sorted(set(x for x, in session.execute(q)))
+        annotations = []
+        for candidate in _iter_candidates(session, cids):
+            for key_name, value in self.annotation_generator(candidate):
+                annotations.append((candidate.id, key_name, value))
+        return index, len(cids), annotations
+
+
+def _iter_candidates(session, cids):
+    """Iterates over the Candidates with the ids cids, loaded SQL_IN_BATCH_SIZE at a time (see load_candidates)"""
+    for i in range(0, len(cids), SQL_IN_BATCH_SIZE):
+        for candidate in load_candidates(session, cids[i:i+SQL_IN_BATCH_SIZE]):
+            yield candidate
+
+
+def function_fingerprint(f):
+    """
+    Returns a fingerprint of the annotation function f, which changes whenever f might compute something
+    different: a hash of its bytecode and constants, together with the values of the globals it references,
+    its closure and its default arguments--recursing into any functions among these.
+
+    Alternatively, a version can be set explicitly on f, e.g. f.version = 2, in which case the fingerprint only
+    changes when this does.
+    """
+    version = getattr(f, 'version', None)
+    if version is not None:
+        return 'version:%s' % (version,)
+    h = hashlib.sha1()
+    _hash_value(h, f, set())
+    return h.hexdigest()
+
+
+def _hash_value(h, value, seen):
+    """Updates the hash h with the value; functions and code objects are hashed by their contents"""
+    if isinstance(value, types.MethodType):
+        value = value.__func__
+    if isinstance(value, types.FunctionType):
+        if id(value) in seen:
+            return
+        seen.add(id(value))
+        _hash_code(h, value.__code__, value.__globals__, seen)
+        for v in value.__defaults__ or ():
+            _hash_value(h, v, seen)
+        for cell in value.__closure__ or ():
+            _hash_value(h, cell.cell_contents, seen)
+    elif isinstance(value, types.ModuleType):
+        h.update('module:' + value.__name__)
+    elif isinstance(value, (type, types.ClassType)):
+        h.update('class:%s.%s' % (value.__module__, value.__name__))
+    else:
+        # NOTE: Falls back to repr, which for objects without a custom repr includes their address, so that
+        # functions referencing them are always considered changed
+        try:
+            h.update(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+        except Exception:
+            h.update(repr(value))
+
+
+def _hash_code(h, code, global_vars, seen):
+    h.update(code.co_code)
+    h.update(repr(code.co_names))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(h, const, global_vars, seen)
+        else:
+            h.update(repr(const))
+    for name in code.co_names:
+        if name in global_vars:
+            _hash_value(h, global_vars[name], seen)
 
 
 def _to_annotation_generator(fns):
@@ -280,3 +653,19 @@ def _to_annotation_generator(fns):
         for f in fns:
             yield f.__name__, f(c)
     return fn_gen
+
+
+def _select_key_ids(session, key_names):
+    """Returns a dict mapping the names of existing AnnotationKeys in key_names to their ids"""
+    key_ids = {}
+    for i in range(0, len(key_names), SQL_IN_BATCH_SIZE):
+        q = select([AnnotationKey.name, AnnotationKey.id])
+        q = q.where(AnnotationKey.name.in_(key_names[i:i+SQL_IN_BATCH_SIZE]))
+        key_ids.update(session.execute(q).fetchall())
+    return key_ids
+
+
+def _select_ids(session, id_col, set_id_col, set_id):
+    """Returns the sorted, distinct ids in id_col of an association table for the set with id set_id"""
+    q = select([id_col]).where(set_id_col == set_id).distinct().order_by(id_col)
+    return np.array([x for x, in session.execute(q)], dtype=np.int64)
@@ -1,15 +1,20 @@
 from . import SnorkelSession
-from .utils import ProgressBar
-from .models import Candidate, CandidateSet, TemporarySpan
+from .utils import collect_worker_results, ProgressBar, reserve_ids, run_worker, SQL_IN_BATCH_SIZE, start_workers
+from .models import Candidate, CandidateSet, Context, Span, TemporarySpan, construct_stable_id
 from .models.candidate import candidate_set_candidate_association
-from itertools import product
-from multiprocessing import Process, Queue, JoinableQueue
+from collections import Counter, namedtuple, OrderedDict
+from itertools import chain, product
+from multiprocessing import Process, Queue
 from sqlalchemy.sql import select
-from Queue import Empty
 from copy import deepcopy
+import numpy as np
 import re
 
-QUEUE_COLLECT_TIMEOUT = 5
+# Number of contexts per batch handed to a CandidateExtractorProcess
+EXTRACTION_BATCH_SIZE = 1000
+
+# Stands in for a parent Context when constructing stable ids from the parent's stable id alone
+StableIdRef = namedtuple('StableIdRef', ['stable_id'])
 
 def gold_stats(candidates, gold):
         """Return precision and recall relative to a "gold" CandidateSet"""
@@ -43,7 +48,7 @@ class CandidateExtractor(object):
     def __init__(self, candidate_class, cspaces, matchers, self_relations=False, nested_relations=False, symmetric_relations=True):
         self.candidate_class     = candidate_class
         self.candidate_spaces    = cspaces if type(cspaces) in [list, tuple] else [cspaces]
-        self.matchers            = matchers if type(matchers) in [list, tuple] else [matchers]
+        self.matchers            = [m.compile() for m in (matchers if type(matchers) in [list, tuple] else [matchers])]
         self.nested_relations    = nested_relations
         self.self_relations      = self_relations
         self.symmetric_relations = symmetric_relations
@@ -57,6 +62,14 @@ class CandidateExtractor(object):
         # Make sure the candidate spaces are different so generators aren't expended!
         self.candidate_spaces = map(deepcopy, self.candidate_spaces)
 
+        # Matchers which occur more than once across the argument matchers, e.g. the same matcher for two arguments
+        # or a child of several composed matchers, share a memo of their results on the candidates of each context
+        # NOTE: The memo is only set on them while matching a context; see _match_child_contexts
+        self.matcher_memo = {}
+        counts = Counter(id(m) for matcher in self.matchers for m in matcher.walk())
+        self.memo_matchers = OrderedDict((id(m), m) for matcher in self.matchers for m in matcher.walk()
+                                         if counts[id(m)] > 1).values()
+
         # Preallocates internal data structures
         self.child_context_sets = [None] * self.arity
         for i in range(self.arity):
@@ -66,42 +79,51 @@ class CandidateExtractor(object):
         self.ps = []
 
     def extract(self, contexts, name, session, parallelism=False):
+        """
+        Extracts Candidates from the contexts into a new CandidateSet with the given name.
+
+        Contexts are processed in batches of EXTRACTION_BATCH_SIZE, and the Spans and Candidates extracted from
+        each batch are persisted in bulk; this requires the candidate spaces to generate TemporarySpans. If
+        parallelism is an integer > 1, the batches (of contiguous context ids) are processed by that many worker
+        processes, each with its own SnorkelSession.
+        """
         # Create a candidate set
         c = CandidateSet(name=name)
         session.add(c)
         session.commit()
 
-        # Run extraction
-        pb = ProgressBar(len(contexts))
+        # Run extraction, persisting the Candidates of each batch of contexts in bulk
         if parallelism in [1, False]:
-            for i, context in enumerate(contexts):
-                pb.bar(i)
-                self._extract_from_context(context, c, session)
+            pb = ProgressBar(len(contexts))
+            for i in range(0, len(contexts), EXTRACTION_BATCH_SIZE):
+                span_args, span_meta = self._extract_batch_span_args(contexts[i:i+EXTRACTION_BATCH_SIZE], pb, i)
+                persist_span_candidates(session, self.candidate_class, c, span_args, span_meta)
+            pb.close()
         else:
-            raise NotImplementedError('Parallelism is not yet implemented.')
-            self._extract_multiprocess(contexts, c, parallelism)
+            self._extract_multiprocess(contexts, c, session, parallelism)
 
-        pb.close()
         session.commit()
         return session.query(CandidateSet).filter(CandidateSet.name == name).one()
 
-    def _extract_from_context(self, context, candidate_set, session):
-        # Generate TemporaryContexts that are children of the context using the candidate_space and filtered
-        # by the Matcher
-        for i in range(self.arity):
-            self.child_context_sets[i].clear()
-            for tc in self.matchers[i].apply(self.candidate_spaces[i].apply(context)):
-                tc.load_id_or_insert(session)
-                self.child_context_sets[i].add(tc)
-
-        # Generates and persists candidates
-        parent_insert_query = Candidate.__table__.insert()
-        parent_insert_args = {'type': self.candidate_class.__mapper_args__['polymorphic_identity']}
-        arg_names = self.candidate_class.__argnames__
-        child_insert_query = self.candidate_class.__table__.insert()
-        child_args = {}
-        set_insert_query = candidate_set_candidate_association.insert()
-        set_insert_args = {'candidate_set_id': candidate_set.id}
+    def _match_child_contexts(self, context):
+        """
+        Generate TemporaryContexts that are children of the context using the candidate_space and filtered
+        by the Matcher, storing them in self.child_context_sets
+        """
+        for m in self.memo_matchers:
+            m.set_shared_memo(self.matcher_memo)
+        try:
+            for i in range(self.arity):
+                self.child_context_sets[i].clear()
+                for tc in self.matchers[i].apply_context(self.candidate_spaces[i], context):
+                    self.child_context_sets[i].add(tc)
+        finally:
+            for m in self.memo_matchers:
+                m.set_shared_memo(None)
+            self.matcher_memo.clear()
+
+    def _candidate_args(self):
+        """Yields the tuples of TemporaryContexts in self.child_context_sets which define Candidates"""
         for args in product(*[enumerate(child_contexts) for child_contexts in self.child_context_sets]):
 
             # Check for self-joins and "nested" joins (joins from span to its subspan)
@@ -116,85 +138,178 @@ class CandidateExtractor(object):
             if self.arity == 2 and not self.symmetric_relations and args[0][0] > args[1][0]:
                 continue
 
-            for i, arg_name in enumerate(arg_names):
-                child_args[arg_name + '_id'] = args[i][1].id
-            q = select([self.candidate_class.id])
-            for key, value in child_args.items():
-                q = q.where(getattr(self.candidate_class, key) == value)
-            candidate_id = session.execute(q).first()
-
-            # If candidate does not exist, persists it
-            if candidate_id is None:
-                candidate_id = session.execute(parent_insert_query, parent_insert_args).inserted_primary_key
-                child_args['id'] = candidate_id[0]
-                session.execute(child_insert_query, child_args)
-                del child_args['id']
-
-            set_insert_args['candidate_id'] = candidate_id[0]
-            session.execute(set_insert_query, set_insert_args)
-            
-    def _extract_multiprocess(self, contexts, candidate_set, parallelism):
-        contexts_in    = JoinableQueue()
-        candidates_out = Queue()
-
-        # Fill the in-queue with contexts
-        for context in contexts:
-            contexts_in.put(context)
+            yield tuple(tc for _, tc in args)
+
+    def _extract_from_context(self, context, candidate_set, session):
+        span_meta = {}
+        span_args = self._extract_span_args(context, span_meta)
+        persist_span_candidates(session, self.candidate_class, candidate_set, span_args, span_meta)
+
+    def _extract_span_args(self, context, span_meta):
+        """
+        Returns the Candidates of the context as tuples of span keys (parent_id, char_start, char_end), one per
+        argument, so that they can be cheaply buffered and passed between processes; adds the meta of any such
+        spans with non-null meta to the dict span_meta
+        """
+        self._match_child_contexts(context)
+        span_args = []
+        for args in self._candidate_args():
+            span_args.append(tuple((tc.parent.id, tc.char_start, tc.char_end) for tc in args))
+            for tc, key in zip(args, span_args[-1]):
+                if tc.meta is not None:
+                    span_meta[key] = tc.meta
+        return span_args
+
+    def _extract_batch_span_args(self, contexts, pb=None, n_done=0):
+        """
+        Returns the span args and span meta (see _extract_span_args) of the batch of contexts, letting candidate
+        spaces which can generate the candidates of many contexts at once do so first (see CandidateSpace.prepare)
+        """
+        spaces = [space for space in self.candidate_spaces if hasattr(space, 'prepare')]
+        for space in spaces:
+            space.prepare(contexts)
+        span_args, span_meta = [], {}
+        try:
+            for i, context in enumerate(contexts):
+                if pb is not None:
+                    pb.bar(n_done + i)
+                span_args.extend(self._extract_span_args(context, span_meta))
+        finally:
+            for space in spaces:
+                space.prepare([])
+        return span_args, span_meta
+
+    def _extract_multiprocess(self, contexts, candidate_set, session, parallelism):
+        ids         = sorted(context.id for context in contexts)
+        context_cls = type(contexts[0]) if len(ids) > 0 else None
+        ids_in      = Queue()
+        args_out    = Queue()
+
+        # Fill the in-queue with batches of contiguous context ids, followed by one stop signal per worker
+        for i in range(0, len(ids), EXTRACTION_BATCH_SIZE):
+            ids_in.put(ids[i:i+EXTRACTION_BATCH_SIZE])
+        for _ in range(parallelism):
+            ids_in.put(None)
 
         # Start worker Processes
-        for i in range(parallelism):
-            session = SnorkelSession()
-            c = session.merge(candidate_set)
-            p = CandidateExtractorProcess(self._extract_from_context, session, contexts_in, candidates_out, c)
-            self.ps.append(p)
-
-        for p in self.ps:
-            p.start()
-        
-        # Join on JoinableQueue of contexts
-        contexts_in.join()
-        
-        # Collect candidates out
-        candidates = []
-        while True:
-            try:
-                candidates.append(candidates_out.get(True, QUEUE_COLLECT_TIMEOUT))
-            except Empty:
-                break
-        return candidates
+        self.ps = [CandidateExtractorProcess(self, context_cls, ids_in, args_out) for _ in range(parallelism)]
+        start_workers(session, self.ps)
+
+        # Collect the candidates extracted from each batch, and persist them in bulk
+        pb     = ProgressBar(len(ids))
+        n_done = 0
+        try:
+            for n_contexts, span_args, span_meta in collect_worker_results(self.ps, args_out,
+                                                                           'CandidateExtractorProcess'):
+                persist_span_candidates(session, self.candidate_class, candidate_set, span_args, span_meta)
+                session.commit()
+                n_done += n_contexts
+                pb.bar(n_done - 1)
+        finally:
+            pb.close()
+        self.ps = []
 
 
 class CandidateExtractorProcess(Process):
-    def __init__(self, extractor, session, contexts_in, candidates_out, candidate_set, unary_set):
+    """
+    Worker process for CandidateExtractor which opens its own SnorkelSession, takes batches of context ids from
+    ids_in, and puts the Candidates extracted from each batch on args_out as tuples of span keys (see
+    CandidateExtractor._extract_span_args). Puts None when done, or the traceback string on error.
+    """
+    def __init__(self, extractor, context_cls, ids_in, args_out):
         Process.__init__(self)
-        self.extractor      = extractor
-        self.session        = session
-        self.contexts_in    = contexts_in
-        self.candidates_out = candidates_out
-        self.candidate_set  = candidate_set
-        self.unary_set      = unary_set
+        self.extractor   = extractor
+        self.context_cls = context_cls
+        self.ids_in      = ids_in
+        self.args_out    = args_out
 
     def run(self):
-        c = self.candidate_set
-        u = self.unary_set if self.unary_set is not None else None
-
-        unique_candidates = set()
-        while True:
-            try:
-                context = self.session.merge(self.contexts_in.get(False))
-                for candidate in self.extractor(context, u):
-                    unique_candidates.add(candidate)
+        run_worker(SnorkelSession(), self.ids_in, self.args_out, self._extract_batch)
 
-                for candidate in unique_candidates:
-                    c.candidates.append(candidate)
+    def _extract_batch(self, session, ids):
+        contexts = session.query(self.context_cls).filter(self.context_cls.id.in_(ids)).all()
+        span_args, span_meta = self.extractor._extract_batch_span_args(contexts)
+        return len(ids), span_args, span_meta
 
-                unique_candidates.clear()
-                self.contexts_in.task_done()
-            except Empty:
-                break
 
-        self.session.commit()
-        self.session.close()
+def persist_span_candidates(session, candidate_class, candidate_set, span_args, span_meta=None):
+    """
+    Bulk persists Candidates given as tuples of span keys (parent_id, char_start, char_end), one per argument,
+    along with their Spans if these are not already in the DB, and adds them to the CandidateSet.
+    New Spans get their meta from the dict span_meta, keyed by span key, if provided.
+    Costs a fixed number of queries per SQL_IN_BATCH_SIZE distinct spans, rather than several per Span and
+    per Candidate.
+    """
+    if len(span_args) == 0:
+        return
+    span_ids = _load_or_insert_spans(session, set(chain.from_iterable(span_args)), span_meta or {})
+
+    # Look up the existing Candidates, by the id of their first argument
+    arg_cols = [getattr(candidate_class, arg_name + '_id') for arg_name in candidate_class.__argnames__]
+    arg_ids  = set(tuple(span_ids[key] for key in args) for args in span_args)
+    first_ids = list(set(ids[0] for ids in arg_ids))
+    candidate_ids = {}
+    for i in range(0, len(first_ids), SQL_IN_BATCH_SIZE):
+        q = select([candidate_class.id] + arg_cols).where(arg_cols[0].in_(first_ids[i:i+SQL_IN_BATCH_SIZE]))
+        for row in session.execute(q):
+            candidate_ids[tuple(row[1:])] = row[0]
+
+    # Insert the new Candidates with explicitly reserved ids
+    new_arg_ids = [ids for ids in arg_ids if ids not in candidate_ids]
+    if len(new_arg_ids) > 0:
+        polymorphic_identity = candidate_class.__mapper_args__['polymorphic_identity']
+        new_ids = reserve_ids(session, Candidate.__table__, len(new_arg_ids))
+        session.execute(Candidate.__table__.insert(), [{'id': cid, 'type': polymorphic_identity} for cid in new_ids])
+        rows = []
+        for cid, ids in zip(new_ids, new_arg_ids):
+            row = dict((col.key, arg_id) for col, arg_id in zip(arg_cols, ids))
+            row['id'] = cid
+            rows.append(row)
+            candidate_ids[ids] = cid
+        session.execute(candidate_class.__table__.insert(), rows)
+
+    # Add the Candidates to the CandidateSet
+    session.execute(candidate_set_candidate_association.insert(),
+                    [{'candidate_set_id': candidate_set.id, 'candidate_id': candidate_ids[ids]} for ids in arg_ids])
+
+
+def _load_or_insert_spans(session, span_keys, span_meta):
+    """
+    Returns a dict mapping span keys (parent_id, char_start, char_end) to Span ids, bulk inserting the Spans
+    which are not already in the DB
+    """
+    span_table = Span.__table__
+    parent_ids = list(set(key[0] for key in span_keys))
+    span_ids   = {}
+    for i in range(0, len(parent_ids), SQL_IN_BATCH_SIZE):
+        q = select([span_table.c.id, span_table.c.parent_id, span_table.c.char_start, span_table.c.char_end])
+        for row in session.execute(q.where(span_table.c.parent_id.in_(parent_ids[i:i+SQL_IN_BATCH_SIZE]))):
+            key = tuple(row[1:])
+            if key in span_keys:
+                span_ids[key] = row[0]
+
+    new_keys = [key for key in span_keys if key not in span_ids]
+    if len(new_keys) > 0:
+
+        # Stable ids are constructed relative to the parent contexts' stable ids
+        new_parent_ids    = list(set(key[0] for key in new_keys))
+        parent_stable_ids = {}
+        for i in range(0, len(new_parent_ids), SQL_IN_BATCH_SIZE):
+            q = select([Context.id, Context.stable_id]).where(Context.id.in_(new_parent_ids[i:i+SQL_IN_BATCH_SIZE]))
+            parent_stable_ids.update(session.execute(q).fetchall())
+
+        new_ids = reserve_ids(session, Context.__table__, len(new_keys))
+        context_rows, span_rows = [], []
+        for span_id, (parent_id, char_start, char_end) in zip(new_ids, new_keys):
+            parent = StableIdRef(parent_stable_ids[parent_id])
+            context_rows.append({'id': span_id, 'type': 'span',
+                                 'stable_id': construct_stable_id(parent, 'span', char_start, char_end)})
+            span_rows.append({'id': span_id, 'parent_id': parent_id, 'char_start': char_start,
+                              'char_end': char_end, 'meta': span_meta.get((parent_id, char_start, char_end))})
+            span_ids[(parent_id, char_start, char_end)] = span_id
+        session.execute(Context.__table__.insert(), context_rows)
+        session.execute(span_table.insert(), span_rows)
+    return span_ids
 
 
 class CandidateSpace(object):
@@ -208,6 +323,13 @@ class CandidateSpace(object):
     def apply(self, x):
         raise NotImplementedError()
 
+    def prepare(self, contexts):
+        """
+        Called with each batch of contexts before candidates are generated from them one at a time, and with []
+        after; a hook for candidate spaces which can generate the candidates of many contexts at once
+        """
+        pass
+
 
 class Ngrams(CandidateSpace):
     """
@@ -218,35 +340,128 @@ class Ngrams(CandidateSpace):
         CandidateSpace.__init__(self)
         self.n_max     = n_max
         self.split_rgx = r'('+r'|'.join(split_tokens)+r')' if split_tokens and len(split_tokens) > 0 else None
+        self._prepared = {}
+
+    def prepare(self, contexts):
+        """
+        Generates the n-grams of the whole batch of contexts at once (see batch_char_ranges), so that char_ranges
+        then only looks them up for each of these contexts
+        """
+        self._prepared = {}
+        if len(contexts) == 0:
+            return
+        idx, starts, ends = self.batch_char_ranges(contexts)
+        bounds = np.searchsorted(idx, np.arange(len(contexts) + 1)).tolist()
+        ranges = zip(starts.tolist(), ends.tolist())
+        for i, context in enumerate(contexts):
+            self._prepared[id(context)] = (context, ranges[bounds[i]:bounds[i+1]])
     
     def apply(self, context):
+        for char_start, char_end in self.char_ranges(context):
+            yield TemporarySpan(char_start=char_start, char_end=char_end, parent=context)
+
+    def char_ranges(self, context):
+        """
+        Lazily generates the distinct n-grams of the context as (char_start, char_end) pairs, in the same order as
+        apply, without constructing a TemporarySpan for each
+        """
+        prepared = self._prepared.get(id(context))
+        if prepared is not None and prepared[0] is context:
+            for char_range in prepared[1]:
+                yield char_range
+            return
 
         # These are the character offset--**relative to the sentence start**--for each _token_
         offsets = context.char_offsets
+        words   = context.words
+        text    = context.text
+
+        split_rgx = re.compile(self.split_rgx) if self.split_rgx is not None else None
 
         # Loop over all n-grams in **reverse** order (to facilitate longest-match semantics)
         L    = len(offsets)
         seen = set()
         for l in range(1, self.n_max+1)[::-1]:
             for i in range(L-l+1):
-                w     = context.words[i+l-1]
                 start = offsets[i]
-                end   = offsets[i+l-1] + len(w) - 1
-                ts    = TemporarySpan(char_start=start, char_end=end, parent=context)
-                if ts not in seen:
-                    seen.add(ts)
-                    yield ts
+                end   = offsets[i+l-1] + len(words[i+l-1]) - 1
+                if (start, end) not in seen:
+                    seen.add((start, end))
+                    yield start, end
 
                 # Check for split
                 # NOTE: For simplicity, we only split single tokens right now!
-                if l == 1 and self.split_rgx is not None:
-                    m = re.search(self.split_rgx, context.text[start-offsets[0]:end-offsets[0]+1])
+                if l == 1 and split_rgx is not None:
+                    m = split_rgx.search(text[start-offsets[0]:end-offsets[0]+1])
                     if m is not None and l < self.n_max + 1:
-                        ts1 = TemporarySpan(char_start=start, char_end=start + m.start(1) - 1, parent=context)
-                        if ts1 not in seen:
-                            seen.add(ts1)
-                            yield ts
-                        ts2 = TemporarySpan(char_start=start + m.end(1), char_end=end, parent=context)
-                        if ts2 not in seen:
-                            seen.add(ts2)
-                            yield ts2
+                        for split in [(start, start + m.start(1) - 1), (start + m.end(1), end)]:
+                            if split not in seen:
+                                seen.add(split)
+                                yield split
+
+    def batch_char_ranges(self, contexts):
+        """
+        Returns the distinct n-grams of all the contexts at once, as NumPy arrays (context_idx, char_start,
+        char_end), where context_idx indexes into contexts; the n-grams of each context are in the same order as
+        generated by char_ranges.
+
+        The offset arithmetic is vectorized over the concatenated tokens of all the contexts; the only per-token
+        Python work is searching each token once for a split token.
+        """
+        lens  = np.array([len(c.char_offsets) for c in contexts], dtype=np.int64)
+        n_tok = int(lens.sum())
+        if n_tok == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        starts = np.fromiter(chain.from_iterable(c.char_offsets for c in contexts), dtype=np.int64, count=n_tok)
+        ends   = starts - 1 + np.fromiter((len(w) for c in contexts for w in c.words), dtype=np.int64, count=n_tok)
+
+        # For each token: the index of its context, its position in the context, and the number of tokens left
+        ctx = np.repeat(np.arange(len(contexts)), lens)
+        pos = np.arange(n_tok) - (np.cumsum(lens) - lens)[ctx]
+        rem = lens[ctx] - pos
+
+        # Rank orders the n-grams of a context as in char_ranges: by length descending, then by position, with
+        # the two parts of a split token directly after it
+        max_len = int(lens.max())
+        rank    = lambda l, p, sub: ((self.n_max - l) * max_len + p) * 3 + sub
+        parts   = []
+        for l in range(self.n_max, 0, -1):
+            i = np.flatnonzero(rem >= l)
+            parts.append((ctx[i], starts[i], ends[i + l - 1], rank(l, pos[i], 0)))
+
+        # Split tokens, searched for in each token's span of the context text
+        if self.split_rgx is not None and self.n_max >= 1:
+            split_rgx = re.compile(self.split_rgx)
+            tok, left_end, right_start = [], [], []
+            k = 0
+            for c in contexts:
+                offsets = c.char_offsets
+                for j, w in enumerate(c.words):
+                    start = offsets[j]
+                    m     = split_rgx.search(c.text, start - offsets[0], start - offsets[0] + len(w))
+                    if m is not None:
+                        tok.append(k + j)
+                        left_end.append(start + m.start(1) - (start - offsets[0]) - 1)
+                        right_start.append(start + m.end(1) - (start - offsets[0]))
+                k += len(offsets)
+            tok = np.array(tok, dtype=np.int64)
+            parts.append((ctx[tok], starts[tok], np.array(left_end, dtype=np.int64), rank(1, pos[tok], 1)))
+            parts.append((ctx[tok], np.array(right_start, dtype=np.int64), ends[tok], rank(1, pos[tok], 2)))
+        ctx, starts, ends, ranks = [np.concatenate(a) for a in zip(*parts)]
+
+        # Keep only the first (lowest ranked) occurrence of each distinct n-gram per context, in rank order; the
+        # sort keys are packed into single int64s, as sorting these is much faster than np.lexsort
+        order  = np.argsort(ctx * (rank(0, max_len, 0) + 1) + ranks, kind='mergesort')
+        lo, hi = min(starts.min(), ends.min()), max(starts.max(), ends.max())
+        width  = hi - lo + 1
+        if len(contexts) * width * width < 2**62:
+            keys = ((ctx * width + (starts - lo)) * width + (ends - lo))[order]
+            dedup = np.argsort(keys, kind='mergesort')
+        else:
+            keys  = np.column_stack((ctx, starts, ends))[order]
+            dedup = np.lexsort((ends[order], starts[order], ctx[order]))
+        keys  = keys[dedup]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = (keys[1:] != keys[:-1]) if keys.ndim == 1 else (keys[1:] != keys[:-1]).any(axis=1)
+        keep  = order[np.sort(dedup[first])]
+        return ctx[keep], starts[keep], ends[keep]
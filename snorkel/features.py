@@ -4,12 +4,46 @@ from pandas import DataFrame
 from collections import defaultdict
 import scipy.sparse as sparse
 from .models import Candidate, CandidateSet, Feature, Span
+from sqlalchemy.orm.session import object_session
 sys.path.append(os.path.join(os.environ['SNORKELHOME'], 'treedlib'))
 from treedlib import compile_relation_feature_generator
 from tree_structs import corenlp_to_xmltree
-from utils import get_as_dict
+from utils import get_as_dict, LRUCache
 from entity_features import *
 
+# Max number of parsed sentences each session holds on to for featurizing their other candidates; see _get_parse
+XMLTREE_CACHE_SIZE = 1000
+
+# TreeDLib feature generators, each compiled once on first use; see _get_tdl_feature_generator
+_tdl_feature_generators = {}
+
+
+def _get_tdl_feature_generator(compile_f):
+    """Returns the TreeDLib feature generator returned by compile_f, e.g. compile_relation_feature_generator"""
+    if compile_f not in _tdl_feature_generators:
+        _tdl_feature_generators[compile_f] = compile_f()
+    return _tdl_feature_generators[compile_f]
+
+
+def _get_parse(context):
+    """
+    Returns the dict of the context's attributes and its dependency XMLTree. These are cached by context id and
+    stable id--as ids of deleted contexts may be reused--for the XMLTREE_CACHE_SIZE most recently used contexts of
+    each session, and shared by all candidates in them, so must not be modified.
+    """
+    session = object_session(context)
+    if session is None or context.id is None:
+        sent = get_as_dict(context)
+        return sent, corenlp_to_xmltree(sent)
+    cache = session.info.setdefault('xmltree_cache', LRUCache(XMLTREE_CACHE_SIZE))
+    key   = (context.id, context.stable_id)
+    parse = cache.get(key)
+    if parse is None:
+        sent  = get_as_dict(context)
+        parse = (sent, corenlp_to_xmltree(sent))
+        cache[key] = parse
+    return parse
+
 
 def get_span_feats(candidate):
     args = candidate.get_arguments()
@@ -18,10 +52,9 @@ def get_span_feats(candidate):
 
     # Unary candidates
     if len(args) == 1:
-        get_tdl_feats = compile_entity_feature_generator()
+        get_tdl_feats = _get_tdl_feature_generator(compile_entity_feature_generator)
         span          = args[0]
-        sent          = get_as_dict(span.parent)
-        xmltree       = corenlp_to_xmltree(sent)
+        sent, xmltree = _get_parse(span.parent)
         sidxs         = range(span.get_word_start(), span.get_word_end() + 1)
         if len(sidxs) > 0:
 
@@ -35,9 +68,9 @@ def get_span_feats(candidate):
 
     # Binary candidates
     elif len(args) == 2:
-        get_tdl_feats = compile_relation_feature_generator()
+        get_tdl_feats = _get_tdl_feature_generator(compile_relation_feature_generator)
         span1, span2  = args
-        xmltree       = corenlp_to_xmltree(get_as_dict(span1.parent))
+        _, xmltree    = _get_parse(span1.parent)
         s1_idxs       = range(span1.get_word_start(), span1.get_word_end() + 1)
         s2_idxs       = range(span2.get_word_start(), span2.get_word_end() + 1)
         if len(s1_idxs) > 0 and len(s2_idxs) > 0:
@@ -1,4 +1,4 @@
-from .models import Span
+from .models import CandidateSet, Span
 from itertools import chain
 from utils import tokens_to_ngrams
 
@@ -135,7 +135,8 @@ def get_matches(lf, candidate_set, match_values=[1,-1]):
     Returns the matched set, which can then be directly put into the Viewer.
     """
     matches = []
-    for c in candidate_set:
+    candidates = candidate_set.iter_eager() if isinstance(candidate_set, CandidateSet) else candidate_set
+    for c in candidates:
         label = lf(c)
         if label in match_values:
             matches.append(c)
@@ -1,3 +1,6 @@
+from .models import TemporarySpan
+from .utils import LRUCache
+from bisect import bisect_left, bisect_right
 import re
 import warnings
 try:
@@ -5,17 +8,40 @@ try:
 except ImportError:
     warnings.warn("nltk not installed- some default functionality may be absent.")
 
+# Max number of memoized stems per DictionaryMatch
+STEM_CACHE_SIZE = 100000
+
+# Characters with special meaning in a regex; a SlotFillMatch split pattern without any is matched literally
+REGEX_META_CHARS = set('.^$*+?{}[]\\|()')
+
+# Min estimated cost of a child Matcher for its results on sub-spans to be memoized once compiled, i.e. for which
+# evaluating it is estimated to cost more than a lookup
+MEMO_MIN_COST = 3.0
+
 
 class Matcher(object):
     """
     Applies a function f : c -> {True,False} to a generator of candidates,
     returning only candidates _c_ s.t. _f(c) == True_,
     where f can be compositionally defined.
+
+    Calling compile() turns the tree of Matchers into an execution plan; see compile.
     """
+    # Rough estimates of the relative cost of _f per candidate, and of the fraction of candidates it accepts, used
+    # to order evaluation once compiled
+    cost      = 1.0
+    pass_rate = 1.0
+
     def __init__(self, *children, **opts):
         self.children           = children
         self.opts               = opts
         self.longest_match_only = self.opts.get('longest_match_only', True)
+        self.compiled           = False
+        self._child_first       = False
+        self._memoized          = [False] * len(children)
+        self._memo              = {}
+        self._memo_parent       = None
+        self._shared_memo       = None
         self.init()
         self._check_opts()
 
@@ -43,10 +69,95 @@ class Matcher(object):
         if len(self.children) == 0:
             return self._f(c)
         elif len(self.children) == 1:
-            return self._f(c) and self.children[0].f(c)
+            if self._child_first:
+                return self.children[0].memo_f(c) and self._f(c)
+            return self._f(c) and self.children[0].memo_f(c)
         else:
             raise Exception("%s does not support more than one child Matcher" % self.__name__)
 
+    def compile(self):
+        """
+        Compiles the tree of Matchers rooted at this one into an execution plan, in place, and returns it:
+            * a Matcher and its child, which must both accept a candidate, are evaluated in order of increasing
+              estimated cost per candidate rejected (see estimated_cost and estimated_pass_rate),
+            * Unions try their children in order of increasing estimated cost per candidate accepted,
+            * the results of children on the sub-spans tried by Concat and SlotFillMatch are memoized by char range,
+              for the sentence currently being matched, if estimated to cost at least MEMO_MIN_COST.
+        The matches are the same as without compiling.
+        """
+        for child in self.children:
+            child.compile()
+        if len(self.children) == 1:
+            self._child_first = _rejection_cost(self.children[0]) < _rejection_cost(self, composed=False)
+        self._memoized = [child.estimated_cost() >= MEMO_MIN_COST for child in self.children]
+        self.compiled  = True
+        return self
+
+    def estimated_cost(self):
+        """The estimated relative cost of evaluating f on a candidate"""
+        return self.cost + sum(child.estimated_cost() for child in self.children)
+
+    def estimated_pass_rate(self):
+        """The estimated fraction of candidates f accepts"""
+        p = self.pass_rate
+        for child in self.children:
+            p *= child.estimated_pass_rate()
+        return p
+
+    def walk(self):
+        """Generates the Matchers of the tree rooted at this one, in pre-order"""
+        yield self
+        for child in self.children:
+            for m in child.walk():
+                yield m
+
+    def set_shared_memo(self, memo):
+        """
+        Sets a memo table of the results of f to be shared with other Matchers which evaluate this one on the same
+        candidates, e.g. the matchers of the different arguments of a CandidateExtractor, keyed by Matcher, parent
+        context, char range and attrib (see _memo_key). Whoever sets it should unset it, with None, when done.
+        """
+        self._shared_memo = memo
+
+    def _memo_key(self, parent, char_start, char_end):
+        """The key in the shared memo table of the result of f on the span of parent with the given char offsets"""
+        parent_key = parent.id if parent.id is not None else parent.stable_id
+        return (id(self), parent_key, char_start, char_end, getattr(self, 'attrib', None))
+
+    def memo_f(self, c):
+        """Evaluates f on candidate c, memoized in the shared memo table if set"""
+        memo = self._shared_memo
+        if memo is None:
+            return self.f(c)
+        key = self._memo_key(c.parent, c.char_start, c.char_end)
+        try:
+            return memo[key]
+        except KeyError:
+            result = memo[key] = self.f(c)
+            return result
+
+    def _child_f(self, i, c, char_start, char_end):
+        """
+        Evaluates child i on the sub-span of candidate c with the given char offsets, memoized by char range in the
+        child's shared memo table if set, or else for the parent of c if compiled and planned so
+        """
+        child = self.children[i]
+        if child._shared_memo is not None:
+            memo = child._shared_memo
+        elif self._memoized[i]:
+            if c.parent is not self._memo_parent:
+                self._memo        = {}
+                self._memo_parent = c.parent
+            memo = self._memo
+        else:
+            return child.f(c._get_instance(char_start=char_start, char_end=char_end, parent=c.parent))
+        key = child._memo_key(c.parent, char_start, char_end)
+        try:
+            return memo[key]
+        except KeyError:
+            result = memo[key] = child.f(c._get_instance(char_start=char_start, char_end=char_end, parent=c.parent))
+            return result
+
     def _is_subspan(self, c, span):
         """Tests if candidate c is subspan of span, where span is defined specific to candidate type"""
         return False
@@ -62,31 +173,135 @@ class Matcher(object):
         """
         seen_spans = set()
         for c in candidates:
-            if self.f(c) and (not self.longest_match_only or not any([self._is_subspan(c, s) for s in seen_spans])):
+            if self.memo_f(c) and (not self.longest_match_only or not any(self._is_subspan(c, s) for s in seen_spans)):
                 if self.longest_match_only:
                     seen_spans.add(self._get_span(c))
                 yield c
 
+    def apply_context(self, candidate_space, context):
+        """
+        Apply the Matcher to the candidates generated from context by candidate_space.
+        Matchers which can find their matches more efficiently by scanning the context directly may override this.
+        """
+        return self.apply(candidate_space.apply(context))
+
+
+def _rejection_cost(matcher, composed=True):
+    """The estimated cost per candidate rejected of evaluating the matcher, or only its _f if not composed"""
+    cost = matcher.estimated_cost() if composed else matcher.cost
+    rate = matcher.estimated_pass_rate() if composed else matcher.pass_rate
+    return cost / max(1.0 - rate, 1e-6)
+
+
+def _acceptance_cost(matcher):
+    """The estimated cost per candidate accepted of evaluating the matcher"""
+    return matcher.estimated_cost() / max(matcher.estimated_pass_rate(), 1e-6)
+
 
 WORDS = 'words'
 
+class SpanContainmentIndex(object):
+    """
+    The (char_start, char_end) spans matched so far in a sentence, indexed for longest-match suppression.
+
+    Only the spans not contained in another are kept, sorted by start--and so, as none contains another, by end
+    too--so that whether a span is contained in any of the matched spans takes a single binary search.
+    """
+    def __init__(self):
+        self.starts = []
+        self.ends   = []
+
+    def contains(self, char_start, char_end):
+        """Tests if the span is contained in a matched span"""
+        i = bisect_right(self.starts, char_start) - 1
+        return i >= 0 and self.ends[i] >= char_end
+
+    def add(self, char_start, char_end):
+        """Adds the span, replacing the matched spans it contains"""
+        if self.contains(char_start, char_end):
+            return
+        i = j = bisect_left(self.starts, char_start)
+        while j < len(self.ends) and self.ends[j] <= char_end:
+            j += 1
+        self.starts[i:j] = [char_start]
+        self.ends[i:j]   = [char_end]
+
+
 class NgramMatcher(Matcher):
     """Matcher base class for Ngram objects"""
+    def apply(self, candidates):
+        """
+        Apply the Matcher to a **generator** of candidates
+        Optionally only takes the longest match (NOTE: assumes this is the *first* match); the matches seen so far
+        are kept in a SpanContainmentIndex, and candidates contained in one are skipped without applying f
+        """
+        # Fall back to the generic implementation if the span semantics have been overridden
+        cls = type(self)
+        if not self.longest_match_only or cls._is_subspan.im_func is not NgramMatcher._is_subspan.im_func \
+                or cls._get_span.im_func is not NgramMatcher._get_span.im_func:
+            for c in super(NgramMatcher, self).apply(candidates):
+                yield c
+            return
+        seen_spans = SpanContainmentIndex()
+        for c in candidates:
+            if not seen_spans.contains(c.char_start, c.char_end) and self.memo_f(c):
+                seen_spans.add(c.char_start, c.char_end)
+                yield c
+
     def _is_subspan(self, c, span):
         """Tests if candidate c is subspan of span, where span is defined specific to candidate type"""
         return c.char_start >= span[0] and c.char_end <= span[1]
 
+    def _map_ranges(self, context, ranges, attrib, sep=" "):
+        """
+        Maps the (char_start, char_end) ranges of candidate Ngrams of the context to the (start, end) of their
+        attrib span in a single string for the whole context: the context text for words, and otherwise the attrib
+        tokens joined by sep. Returns the string, a dict from range to (start, end), and a list of the ranges
+        which cannot be mapped, e.g. because they start before the first token.
+        """
+        if attrib == WORDS:
+            return context.text, dict((r, r) for r in ranges), []
+        tokens = context.__getattribute__(attrib)
+        starts = [0]
+        for t in tokens[:-1]:
+            starts.append(starts[-1] + len(t) + len(sep))
+        spans, unmapped = {}, []
+        for s, e in ranges:
+            ts     = TemporarySpan(char_start=s, char_end=e, parent=context)
+            ws, we = ts.get_word_start(), ts.get_word_end()
+            if ws is None or ws < 0 or we < ws:
+                unmapped.append((s, e))
+            else:
+                spans[(s, e)] = (starts[ws], starts[we] + len(tokens[we]) - 1)
+        return sep.join(tokens), spans, unmapped
+
     def _get_span(self, c):
         """Gets a tuple that identifies a span for the specific candidate class that c belongs to"""
         return (c.char_start, c.char_end)
 
 
 class DictionaryMatch(NgramMatcher):
-    """Selects candidate Ngrams that match against a given list d"""
+    """
+    Selects candidate Ngrams that match against a given list d
+
+    With trie=True, candidates from an Ngrams candidate space are matched by scanning each sentence once: the
+    dictionary is kept as the sorted list of phrases, rather than as a node trie, where the phrases starting with a
+    prefix are a range found by bisection; the n-grams starting at each position are extended only while some
+    phrase starts with them. The char ranges of all the n-grams are still generated, to keep the order of the
+    candidate space, but TemporarySpans are only created for the matches.
+
+    Stems are memoized; with stem_tokens=True, phrases--both in the dictionary and of candidates--are stemmed token
+    by token (split on single spaces) rather than as a whole, so that the stems of recurring tokens are reused
+    across the many candidates containing them.
+    """
+    cost      = 1.0
+    pass_rate = 0.01
+
     def init(self):
         self.ignore_case = self.opts.get('ignore_case', True)
         self.attrib      = self.opts.get('attrib', WORDS)
         self.reverse     = self.opts.get('reverse', False)
+        self.trie        = self.opts.get('trie', False)
         try:
             self.d = frozenset(w.lower() if self.ignore_case else w for w in self.opts['d'])
         except KeyError:
@@ -94,18 +309,38 @@ class DictionaryMatch(NgramMatcher):
 
         # Optionally use a stemmer, preprocess the dictionary
         # Note that user can provide *an object having a stem() method*
-        self.stemmer = self.opts.get('stemmer', None)
+        self.stemmer     = self.opts.get('stemmer', None)
+        self.stem_tokens = self.opts.get('stem_tokens', False)
+        self._stem_cache = LRUCache(STEM_CACHE_SIZE)
         if self.stemmer is not None:
             if self.stemmer == 'porter':
                 self.stemmer = PorterStemmer()
             self.d = frozenset(self._stem(w) for w in list(self.d))
+            self.cost = 3.0
+        if self.reverse:
+            self.pass_rate = 1.0 - self.pass_rate
+
+        # Sort the phrases, for prefix lookups by bisection
+        if self.trie:
+            if self.stemmer is not None or self.reverse:
+                raise ValueError("DictionaryMatch does not support trie=True with a stemmer or reverse=True.")
+            self._phrases = sorted(self.d)
 
     def _stem(self, w):
         """Apply stemmer, handling encoding errors"""
-        try:
-            return self.stemmer.stem(w)
-        except UnicodeDecodeError:
-            return w
+        if self.stem_tokens:
+            return ' '.join(self._stem_memo(t) for t in w.split(' '))
+        return self._stem_memo(w)
+
+    def _stem_memo(self, w):
+        s = self._stem_cache.get(w)
+        if s is None:
+            try:
+                s = self.stemmer.stem(w)
+            except UnicodeDecodeError:
+                s = w
+            self._stem_cache[w] = s
+        return s
 
     def _f(self, c):
         p = c.get_attrib_span(self.attrib)
@@ -113,8 +348,46 @@ class DictionaryMatch(NgramMatcher):
         p = self._stem(p) if self.stemmer is not None else p
         return (not self.reverse) if p in self.d else self.reverse
 
+    def apply_context(self, candidate_space, context):
+        if not self.trie or not hasattr(candidate_space, 'char_ranges'):
+            return super(DictionaryMatch, self).apply_context(candidate_space, context)
+        ranges  = list(candidate_space.char_ranges(context))
+        matches = self._scan(context, ranges)
+        return self.apply(TemporarySpan(char_start=s, char_end=e, parent=context) for s, e in ranges
+                          if (s, e) in matches)
+
+    def _scan(self, context, ranges):
+        """Returns the set of the (char_start, char_end) ranges whose attrib span is in the dictionary"""
+        text, spans, unmapped = self._map_ranges(context, ranges, self.attrib)
+        text = text.lower() if self.ignore_case else text
+
+        # From each start, scan the span ends in increasing order, until no phrase starts with the span
+        ends = {}
+        for start, end in set(spans.itervalues()):
+            ends.setdefault(start, []).append(end)
+        phrases = self._phrases
+        n       = len(phrases)
+        matched = set()
+        for start, span_ends in ends.iteritems():
+            if len(span_ends) > 1:
+                span_ends.sort()
+            for end in span_ends:
+                p = text[start:end + 1]
+                i = bisect_left(phrases, p)
+                if i == n or not phrases[i].startswith(p):
+                    break
+                if phrases[i] == p:
+                    matched.add((start, end))
+        matches = set(r for r, span in spans.iteritems() if span in matched)
+        matches.update(r for r in unmapped if self._f(TemporarySpan(char_start=r[0], char_end=r[1], parent=context)))
+        return matches
+
+
 class LambdaFunctionMatch(NgramMatcher):
     """Selects candidate Ngrams that match against a given list d"""
+    cost      = 5.0
+    pass_rate = 0.5
+
     def init(self):
         self.ignore_case = self.opts.get('ignore_case', True)
         self.attrib      = self.opts.get('attrib', WORDS)
@@ -131,17 +404,38 @@ class LambdaFunctionMatch(NgramMatcher):
 class Union(NgramMatcher):
     """Takes the union of candidate sets returned by child operators"""
     def f(self, c):
-       for child in self.children:
-           if child.f(c) > 0:
+       for child in self._children_order:
+           if child.memo_f(c) > 0:
                return True
        return False
 
+    def init(self):
+        self._children_order = self.children
+
+    def compile(self):
+        super(Union, self).compile()
+        self._children_order = sorted(self.children, key=lambda child: _acceptance_cost(child))
+        return self
+
+    def estimated_cost(self):
+        return sum(child.estimated_cost() for child in self.children)
+
+    def estimated_pass_rate(self):
+        p = 1.0
+        for child in self.children:
+            p *= 1.0 - child.estimated_pass_rate()
+        return 1.0 - p
+
 
 class Concat(NgramMatcher):
     """
     Selects candidates which are the concatenation of adjacent matches from child operators
     NOTE: Currently slices on **word index** and considers concatenation along these divisions only
     """
+    # Children are evaluated on each split of each candidate
+    cost      = 10.0
+    pass_rate = 0.01
+
     def init(self):
         self.permutations   = self.opts.get('permutations', False)
         self.left_required  = self.opts.get('left_required', True)
@@ -152,9 +446,9 @@ class Concat(NgramMatcher):
     def f(self, c):
         if len(self.children) != 2:
             raise ValueError("Concat takes two child Matcher objects as arguments.")
-        if not self.left_required and self.children[1].f(c):
+        if not self.left_required and self.children[1].memo_f(c):
             return True
-        if not self.right_required and self.children[0].f(c):
+        if not self.right_required and self.children[0].memo_f(c):
             return True
 
         # Iterate over candidate splits **at the word boundaries**
@@ -163,17 +457,28 @@ class Concat(NgramMatcher):
 
             # Optionally check for specific separator
             if self.ignore_sep or c.get_span()[csplit-1] == self.sep:
-                c1 = c[:csplit-len(self.sep)]
-                c2 = c[csplit:]
-                if self.children[0].f(c1) and self.children[1].f(c2):
+                # The char ranges of c[:csplit-len(self.sep)] and c[csplit:]
+                stop = csplit - len(self.sep)
+                c1   = (c.char_start, c.char_start + stop - 1 if stop >= 0 else c.char_end + stop)
+                c2   = (c.char_start + csplit, c.char_end)
+                if self._child_f(0, c, *c1) and self._child_f(1, c, *c2):
                     return True
-                if self.permutations and self.children[1].f(c1) and self.children[0].f(c2):
+                if self.permutations and self._child_f(1, c, *c1) and self._child_f(0, c, *c2):
                     return True
         return False
 
+    def estimated_cost(self):
+        return self.cost * (1.0 + sum(child.estimated_cost() for child in self.children))
+
+    def estimated_pass_rate(self):
+        return self.pass_rate
+
 
 class SlotFillMatch(NgramMatcher):
     """Matches a slot fill pattern of matchers _at the character level_"""
+    cost      = 3.0
+    pass_rate = 0.01
+
     def init(self):
         self.attrib = self.opts.get('attrib', WORDS)
         try:
@@ -195,22 +500,51 @@ class SlotFillMatch(NgramMatcher):
             raise ValueError("Number of provided matchers (%s) != number of slots (%s)." \
                     % (len(self.children), len(set(self._ops))))
 
+        # Compile the full splits pattern once
+        self._r = re.compile(r'(.+)'.join(self._splits) + r'$')
+
+        # Literal splits, checked as substrings before running the regex
+        literal       = lambda s : len(s) > 0 and not any(ch in REGEX_META_CHARS for ch in s)
+        self._prefix  = self._splits[0] if literal(self._splits[0]) else None
+        self._suffix  = self._splits[-1] if len(self._splits) > 1 and literal(self._splits[-1]) else None
+        self._infixes = [s for s in self._splits[1:-1] if literal(s)]
+
+    def _prefilter(self, text):
+        """Returns False if the text cannot match the splits pattern, based on its literal splits"""
+        if self._prefix is not None and not text.startswith(self._prefix):
+            return False
+        if self._suffix is not None and not text.endswith(self._suffix):
+            return False
+        return all(s in text for s in self._infixes)
+
     def f(self, c):
 
         # First, filter candidates by matching splits pattern
-        m = re.match(r'(.+)'.join(self._splits) + r'$', c.get_attrib_span(self.attrib))
+        text = c.get_attrib_span(self.attrib)
+        if not self._prefilter(text):
+            return False
+        m = self._r.match(text)
         if m is None:
             return False
 
         # Then, recursively apply matchers
         for i,op in enumerate(self._ops):
-            if self.children[op].f(c[m.start(i+1):m.end(i+1)]) == 0:
+            if self._child_f(op, c, c.char_start + m.start(i+1), c.char_start + m.end(i+1) - 1) == 0:
                 return False
         return True
 
+    def estimated_cost(self):
+        return self.cost + self.pass_rate * sum(child.estimated_cost() for child in self.children)
+
+    def estimated_pass_rate(self):
+        return self.pass_rate
+
 
 class RegexMatch(NgramMatcher):
     """Base regex class- does not specify specific semantics of *what* is being matched yet"""
+    cost      = 2.0
+    pass_rate = 0.1
+
     def init(self):
         try:
             self.rgx = self.opts['rgx']
@@ -229,11 +563,69 @@ class RegexMatch(NgramMatcher):
         raise NotImplementedError()
 
 
+# Matches the assertions on what precedes a position in a regex, conservatively, e.g. also escaped ^ or \b
+UNSCANNABLE_RGX = re.compile(r'\\[AbB]|\(\?<[=!]|(?<!\[)\^')
+
+
 class RegexMatchSpan(RegexMatch):
-    """Matches regex pattern on **full concatenated span**"""
+    """
+    Matches regex pattern on **full concatenated span**
+
+    With scan=True, candidates from an Ngrams candidate space are matched by scanning each sentence: the pattern
+    is searched for from candidate start to candidate start, so that only the ends of candidates starting where the
+    pattern matches are tested against the full-span pattern. The matches are the same as per candidate; patterns
+    which may assert what precedes a position (^, \\A, \\b, \\B or lookbehinds), which would see the rest of the
+    sentence rather than the start of the span, are matched per candidate instead.
+    """
+    def init(self):
+        super(RegexMatchSpan, self).init()
+        self.scan = self.opts.get('scan', False) and UNSCANNABLE_RGX.search(self.rgx) is None
+        if self.scan:
+            # The trailing $ is dropped when searching, as a full-span match may end anywhere in the sentence;
+            # patterns with other assertions on what follows a match cannot be searched for, as the end of a span
+            # is the end of the string when matched per candidate, so all candidate starts are tried instead
+            n_escapes = len(self.rgx) - 1 - len(self.rgx[:-1].rstrip('\\'))
+            rgx       = self.rgx[:-1] if n_escapes % 2 == 0 else self.rgx
+            if re.search(r'\\[bBZ]|\(\?[=!]|\$', rgx):
+                self.r_search = None
+            else:
+                self.r_search = re.compile(rgx, flags=self.r.flags)
+
     def _f(self, c):
         return True if self.r.match(c.get_attrib_span(self.attrib, sep=self.sep)) is not None else False
 
+    def apply_context(self, candidate_space, context):
+        if not self.scan or not hasattr(candidate_space, 'char_ranges'):
+            return super(RegexMatchSpan, self).apply_context(candidate_space, context)
+        ranges = list(candidate_space.char_ranges(context))
+        text, spans, unmapped = self._map_ranges(context, ranges, self.attrib, self.sep)
+
+        # Search for the pattern from each candidate start on, skipping to the first candidate start at or after
+        # the match; the full-span pattern is matched with endpos, so that $ matches at the end of the span
+        ends = {}
+        for start, end in set(spans.itervalues()):
+            ends.setdefault(start, []).append(end)
+        starts  = sorted(ends)
+        matched = set()
+        i = 0
+        while i < len(starts):
+            if self.r_search is not None:
+                m = self.r_search.search(text, starts[i])
+                if m is None:
+                    break
+                i = bisect_left(starts, m.start(), i)
+            else:
+                m = None
+            if i < len(starts) and (m is None or starts[i] == m.start()):
+                for end in ends[starts[i]]:
+                    if self.r.match(text, starts[i], end + 1) is not None:
+                        matched.add((starts[i], end))
+                i += 1
+        matches = set(r for r, span in spans.iteritems() if span in matched)
+        matches.update(r for r in unmapped if self._f(TemporarySpan(char_start=r[0], char_end=r[1], parent=context)))
+        return self.apply(TemporarySpan(char_start=s, char_end=e, parent=context) for s, e in ranges
+                          if (s, e) in matches)
+
 
 class RegexMatchEach(RegexMatch):
     """Matches regex pattern on **each token**"""
@@ -38,7 +38,7 @@ define a new type of Context is:
 from .meta import SnorkelBase, SnorkelSession, snorkel_engine, snorkel_postgres
 from .context import Context, Corpus, Document, Sentence, TemporarySpan, Span
 from .context import construct_stable_id, split_stable_id
-from .candidate import Candidate, CandidateSet, candidate_subclass
+from .candidate import Candidate, CandidateSet, candidate_subclass, load_candidates
 from .annotation import Feature, Label, Prediction, AnnotationKey, AnnotationKeySet
 from .parameter import Parameter, ParameterSet
 
@@ -1,13 +1,17 @@
 from .meta import SnorkelSession, SnorkelBase
-from .context import Context
+from .context import Context, Span
+from collections import defaultdict
 from sqlalchemy import Table, Column, String, Integer, ForeignKey, UniqueConstraint
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, joinedload, with_polymorphic
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import select
 from snorkel.models import snorkel_engine
-from snorkel.utils import camel_to_under
+from snorkel.utils import camel_to_under, SQL_IN_BATCH_SIZE
 
 
 candidate_set_candidate_association = Table('candidate_set_candidate_association', SnorkelBase.metadata,
-                                            Column('candidate_set_id', Integer, ForeignKey('candidate_set.id')),
+                                            Column('candidate_set_id', Integer, ForeignKey('candidate_set.id'),
+                                                   index=True),
                                             Column('candidate_id', Integer, ForeignKey('candidate.id')))
 
 
@@ -38,6 +42,34 @@ class CandidateSet(SnorkelBase):
         for candidate in self.candidates:
             yield candidate
 
+    def iter_eager(self, page_size=SQL_IN_BATCH_SIZE):
+        """
+        Iterates over the Candidates in id order, paging by id, page_size at a time; the arguments and parent
+        Contexts of each page of Candidates are loaded up front, in a fixed number of queries (see load_candidates).
+
+        NOTE: Unlike iterating over self.candidates, each Candidate is yielded once, in id order; pending changes are
+        flushed first, as a query would. If the CandidateSet is not attached to a session, iterates over
+        self.candidates instead.
+        """
+        session = SnorkelSession.object_session(self)
+        if session is None:
+            for candidate in self.candidates:
+                yield candidate
+            return
+        if session.autoflush:
+            session.flush()
+        cid     = candidate_set_candidate_association.c.candidate_id
+        q       = select([cid]).where(candidate_set_candidate_association.c.candidate_set_id == self.id)
+        last_id = None
+        while True:
+            page_q = q.where(cid > last_id) if last_id is not None else q
+            ids    = [x for x, in session.execute(page_q.distinct().order_by(cid).limit(page_size))]
+            if len(ids) == 0:
+                return
+            for candidate in load_candidates(session, ids):
+                yield candidate
+            last_id = ids[-1]
+
     def __getitem__(self, key):
         return self.candidates[key]
 
@@ -86,6 +118,41 @@ class Candidate(SnorkelBase):
         return u"%s(%s)" % (self.__class__.__name__, u", ".join(map(unicode, self.get_arguments())))
 
 
+def load_candidates(session, ids):
+    """
+    Returns the Candidates with the given ids, in the same order, along with their Span arguments and the parent
+    Contexts of these, e.g. Sentences--which would otherwise each be loaded lazily, in separate queries per
+    Candidate--in a fixed number of queries per SQL_IN_BATCH_SIZE ids.
+    """
+    candidates = {}
+    for i in range(0, len(ids), SQL_IN_BATCH_SIZE):
+        batch = ids[i:i+SQL_IN_BATCH_SIZE]
+
+        # Load the Candidates of each subclass together with their arguments
+        ids_by_type = defaultdict(list)
+        for cid, candidate_type in session.execute(select([Candidate.id, Candidate.type]).where(Candidate.id.in_(batch))):
+            ids_by_type[candidate_type].append(cid)
+        for candidate_type, type_ids in ids_by_type.iteritems():
+            cls  = Candidate.__mapper__.polymorphic_map[candidate_type].class_
+            args = [joinedload(getattr(cls, arg).of_type(Span)) for arg in getattr(cls, '__argnames__', [])]
+            for candidate in session.query(cls).options(*args).filter(cls.id.in_(type_ids)):
+                candidates[candidate.id] = candidate
+
+    # Load the distinct parent Contexts of the Span arguments, including the columns of their subclass, and set
+    # them as loaded on the Spans
+    spans      = [arg for c in candidates.itervalues() for arg in c.get_arguments() if isinstance(arg, Span)]
+    parent_ids = list(set(span.parent_id for span in spans))
+    parents    = {}
+    context    = with_polymorphic(Context, '*')
+    for i in range(0, len(parent_ids), SQL_IN_BATCH_SIZE):
+        for parent in session.query(context).filter(context.id.in_(parent_ids[i:i+SQL_IN_BATCH_SIZE])):
+            parents[parent.id] = parent
+    for span in spans:
+        if 'parent' not in span.__dict__ and span.parent_id in parents:
+            set_committed_value(span, 'parent', parents[span.parent_id])
+    return [candidates[cid] for cid in ids if cid in candidates]
+
+
 def candidate_subclass(class_name, args, table_name=None):
     """
     Creates and returns a Candidate subclass with provided argument names, which are Context type.
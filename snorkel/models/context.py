@@ -1,12 +1,25 @@
 from .meta import SnorkelBase, snorkel_postgres
-from sqlalchemy import Column, String, Integer, Table, Text, ForeignKey, UniqueConstraint, func
+from bisect import bisect_left
+import cPickle
+from sqlalchemy import Column, String, Integer, Table, Text, ForeignKey, UniqueConstraint, event, func
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import relationship, backref
-from sqlalchemy.types import PickleType
+from sqlalchemy.types import LargeBinary, PickleType, TypeDecorator
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm.session import object_session
 from sqlalchemy.sql import select, text
+import numpy as np
 import pandas as pd
+from snorkel.utils import LRUCache
+
+# Max number of loaded Sentences each session holds on to; see _hold_loaded_sentence
+SENTENCE_CACHE_SIZE = 100
+
+# Separates the elements of a StringArray
+STRING_ARRAY_SEP = u'\x1f'
+
+# Prefix of values pickled by PickleType with protocol 2, as Sentence arrays were stored on SQLite previously
+PICKLE_PREFIX = '\x80\x02'
 
 
 corpus_document_association = Table('corpus_document_association', SnorkelBase.metadata,
@@ -109,6 +122,63 @@ class Document(Context):
         return "Document " + str(self.name)
 
 
+def _load_pickled_array(value, type_name):
+    """
+    Returns the list value pickled by PickleType, in which Sentence arrays were stored on SQLite before IntArray and
+    StringArray; raises a ValueError if value is not one, as it cannot be decoded as a type_name either
+    """
+    try:
+        loaded = cPickle.loads(value.encode('latin-1') if isinstance(value, unicode) else str(value))
+    except Exception:
+        loaded = None
+    if not isinstance(loaded, (list, tuple)):
+        raise ValueError('Could not decode %s value of the database: if it was created by an older version of '
+                         'Snorkel, which stored Sentence arrays pickled, re-parse the corpus into a new database.'
+                         % type_name)
+    return list(loaded)
+
+
+class IntArray(TypeDecorator):
+    """A list of ints, stored as a packed array of little-endian int32s; used in place of ARRAY(Integer) on SQLite"""
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return np.asarray(value, dtype='<i4').tostring()
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if value[:2] == PICKLE_PREFIX or len(value) % 4 != 0:
+            try:
+                return _load_pickled_array(value, 'IntArray')
+            except ValueError:
+                if len(value) % 4 != 0:
+                    raise
+        return np.frombuffer(value, dtype='<i4').tolist()
+
+
+class StringArray(TypeDecorator):
+    """
+    A list of unicode strings, stored as a single delimited string; used in place of ARRAY(String) on SQLite.
+    Each element is prefixed by STRING_ARRAY_SEP, so that [] and [u''] are distinct.
+    """
+    impl = Text
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return u''.join(STRING_ARRAY_SEP + v for v in value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, unicode) or (len(value) > 0 and value[0] != STRING_ARRAY_SEP):
+            return [unicode(v) for v in _load_pickled_array(value, 'StringArray')]
+        return value.split(STRING_ARRAY_SEP)[1:]
+
+
 class Sentence(Context):
     """A sentence Context in a Document."""
     __tablename__ = 'sentence'
@@ -126,13 +196,13 @@ class Sentence(Context):
         dep_parents = Column(postgresql.ARRAY(Integer))
         dep_labels = Column(postgresql.ARRAY(String))
     else:
-        words = Column(PickleType, nullable=False)
-        char_offsets = Column(PickleType, nullable=False)
-        lemmas = Column(PickleType)
-        pos_tags = Column(PickleType)
-        ner_tags = Column(PickleType)
-        dep_parents = Column(PickleType)
-        dep_labels = Column(PickleType)
+        words = Column(StringArray, nullable=False)
+        char_offsets = Column(IntArray, nullable=False)
+        lemmas = Column(StringArray)
+        pos_tags = Column(StringArray)
+        ner_tags = Column(StringArray)
+        dep_parents = Column(IntArray)
+        dep_labels = Column(StringArray)
 
     __mapper_args__ = {
         'polymorphic_identity': 'sentence',
@@ -161,6 +231,17 @@ class Sentence(Context):
         return "Sentence" + str((self.document, self.position, self.text))
 
 
+@event.listens_for(Sentence, 'load')
+def _hold_loaded_sentence(sentence, context):
+    """
+    Keeps the SENTENCE_CACHE_SIZE most recently loaded Sentences of each session referenced, so that they stay in
+    its identity map: repeated accesses, e.g. span.parent for many candidates in the same sentence, then do not
+    reload and decode the sentence's rows. Set SENTENCE_CACHE_SIZE to 0 to disable.
+    """
+    if SENTENCE_CACHE_SIZE > 0:
+        context.session.info.setdefault('sentence_cache', LRUCache(SENTENCE_CACHE_SIZE))[sentence.id] = sentence
+
+
 class TemporaryContext(object):
     """
     A context which does not incur the overhead of a proper ORM-based Context object.
@@ -173,6 +254,8 @@ class TemporaryContext(object):
     A TemporaryContext must have specified equality / set membership semantics, a stable_id for checking
     uniqueness against the database, and a promote() method which returns a corresponding Context object.
     """
+    __slots__ = ('id',)
+
     def __init__(self):
         self.id = None
 
@@ -216,13 +299,29 @@ class TemporaryContext(object):
 
 
 class TemporarySpan(TemporaryContext):
-    """The TemporaryContext version of Span"""
+    """
+    The TemporaryContext version of Span.
+
+    Many are created per sentence during candidate extraction, so TemporarySpans use __slots__ rather than a
+    __dict__, and their hash is computed once, rather than through the ORM parent on every lookup.
+    """
+    __slots__ = ('parent', 'char_start', 'char_end', 'meta', '_word_range', '_hash')
+
     def __init__(self, parent, char_start, char_end, meta=None):
-        super(TemporarySpan, self).__init__()
+        self.id         = None
         self.parent     = parent  # The parent Context of the Span
         self.char_end   = char_end
         self.char_start = char_start
         self.meta       = meta
+        self._cache_hash()
+
+    def __getstate__(self):
+        return dict((k, getattr(self, k)) for k in ('id', 'parent', 'char_start', 'char_end', 'meta')
+                    if hasattr(self, k))
+
+    def __setstate__(self, state):
+        for k, v in state.iteritems():
+            setattr(self, k, v)
 
     def __len__(self):
         return self.char_end - self.char_start + 1
@@ -242,7 +341,21 @@ class TemporarySpan(TemporaryContext):
             return True
 
     def __hash__(self):
-        return hash(self.parent) + hash(self.char_start) + hash(self.char_end)
+        cached = getattr(self, '_hash', None)
+        if cached is None or cached[0] is not self.parent or cached[1] != self.char_start \
+                or cached[2] != self.char_end:
+            cached = self._cache_hash()
+        return cached[3]
+
+    def _cache_hash(self):
+        """
+        Computes the hash of the span, cached along with the parent and chars it is computed from, so that it is
+        recomputed if these are reassigned; it is not cached while the parent has no id, as it gets one on flush
+        """
+        parent_id = self.parent.id
+        cached    = (self.parent, self.char_start, self.char_end, hash((parent_id, self.char_start, self.char_end)))
+        self._hash = cached if parent_id is not None else None
+        return cached
 
     def get_stable_id(self):
         return construct_stable_id(self.parent, self._get_polymorphic_identity(), self.char_start, self.char_end)
@@ -263,23 +376,30 @@ class TemporarySpan(TemporaryContext):
                 'meta'      : self.meta}
 
     def get_word_start(self):
-        return self.char_to_word_index(self.char_start)
+        return self._get_word_range()[0]
 
     def get_word_end(self):
-        return self.char_to_word_index(self.char_end)
+        return self._get_word_range()[1]
+
+    def _get_word_range(self):
+        """Returns the (start, end) word indices of the span, computed once and memoized on the span"""
+        chars  = (self.char_start, self.char_end)
+        cached = getattr(self, '_word_range', None)
+        if cached is None or cached[0] != chars:
+            cached = self._word_range = (chars, (self.char_to_word_index(chars[0]), self.char_to_word_index(chars[1])))
+        return cached[1]
 
     def get_n(self):
         return self.get_word_end() - self.get_word_start() + 1
 
     def char_to_word_index(self, ci):
         """Given a character-level index (offset), return the index of the **word this char is in**"""
-        i = None
-        for i, co in enumerate(self.parent.char_offsets):
-            if ci == co:
-                return i
-            elif ci < co:
-                return i-1
-        return i
+        # Binary search over the parent's (sorted) char_offsets, shared by all spans of the parent
+        offsets = self.parent.char_offsets
+        if len(offsets) == 0:
+            return None
+        i = bisect_left(offsets, ci)
+        return i if i < len(offsets) and offsets[i] == ci else i - 1
 
     def word_to_char_index(self, wi):
         """Given a word-level index, return the character-level index (offset) of the word's start"""
@@ -356,6 +476,13 @@ class Span(Context, TemporarySpan):
     def _get_instance(self, **kwargs):
         return Span(**kwargs)
 
+    # Spans are pickled by their __dict__, as ORM objects, rather than by TemporarySpan's slots
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
     # We redefine these to use default semantics, overriding the operators inherited from TemporarySpan
     def __eq__(self, other):
         return self is other
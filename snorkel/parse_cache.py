@@ -0,0 +1,67 @@
+import glob
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+
+def corenlp_version(loc):
+    """Returns the version of the CoreNLP jar in the directory loc, e.g. '3.6.0', or None if none is found"""
+    for jar in sorted(glob.glob(os.path.join(loc, 'stanford-corenlp-*.jar'))):
+        version = os.path.basename(jar)[len('stanford-corenlp-'):-len('.jar')]
+        if not any(version.endswith(s) for s in ('-models', '-sources', '-javadoc')):
+            return version
+    return None
+
+
+class ParseCache(object):
+    """
+    A content-addressed, on-disk cache of CoreNLP server responses.
+
+    Entries are keyed by a hash of the document text together with everything else which determines the parse--
+    the annotators, the tokenizer options and the CoreNLP version--and stored as gzipped JSON, sharded into
+    subdirectories by the first two hex digits of the key.
+    """
+    def __init__(self, cache_dir, annotators, tok_whitespace, version):
+        self.cache_dir = cache_dir
+        self.config    = json.dumps([annotators, tok_whitespace, version])
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def key(self, text):
+        """Returns the key for the raw document text, as a utf-8 encoded string"""
+        h = hashlib.sha1(self.config)
+        h.update('\0')
+        h.update(text)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json.gz')
+
+    def get(self, key):
+        """Returns the cached response content for the key, or None if there is no entry"""
+        try:
+            with gzip.open(self._path(key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put(self, key, content):
+        """Stores the response content for the key"""
+        path    = self._path(key)
+        sub_dir = os.path.dirname(path)
+        if not os.path.isdir(sub_dir):
+            try:
+                os.makedirs(sub_dir)
+            except OSError:
+                # Another thread or process may have just created it
+                if not os.path.isdir(sub_dir):
+                    raise
+
+        # Write to a temporary file first, so that entries are never read partially written
+        fd, tmp_path = tempfile.mkstemp(dir=sub_dir)
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                f.write(content)
+        os.rename(tmp_path, path)
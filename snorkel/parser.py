@@ -1,21 +1,35 @@
 # -*- coding: utf-8 -*-
 
-from .models import Corpus, Document, Sentence, construct_stable_id
-from .utils import ProgressBar, sort_X_on_Y
+from .models import Context, Corpus, Document, Sentence, construct_stable_id
+from .models.context import corpus_document_association
+from .parse_cache import ParseCache, corenlp_version
+from .utils import ProgressBar, reserve_ids, sort_X_on_Y
 import atexit
 import warnings
 from bs4 import BeautifulSoup
-from collections import defaultdict
+from collections import defaultdict, deque
 import glob
+from itertools import islice
 import json
 import lxml.etree as et
 import os
 import re
 import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import signal
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen
 import sys
 import codecs
+import threading
+from sqlalchemy.sql import select
+
+# Sentence table columns set from the output of a SentenceParser when bulk inserting
+SENTENCE_COLUMNS = [col.key for col in Sentence.__table__.columns if col.key not in ['id', 'document_id']]
+
+# Seconds after which a CoreNLP server times out a request itself
+SERVER_TIMEOUT = 600
 
 
 class CorpusParser:
@@ -25,20 +39,29 @@ class CorpusParser:
         self.sent_parser = sent_parser
         self.max_docs = max_docs
 
-    def parse_corpus(self, session, name):
+    def parse_corpus(self, session, name, commit_every=None, parallelism=1):
+        """
+        Parses the documents into a new Corpus with the given name.
+
+        If commit_every is an integer, parsing is streamed: Documents and Sentences are bulk inserted and
+        committed every commit_every documents without being held in the session, so memory use does not grow
+        with the size of the corpus. If a Corpus with this name already exists, its documents are skipped, so
+        that an interrupted run can be resumed from the last commit.
+
+        If parallelism > 1, up to that many documents are parsed concurrently by the SentenceParser (see
+        SentenceParser.parse_docs).
+        """
+        if commit_every is not None:
+            return self._parse_corpus_streaming(session, name, commit_every, parallelism)
         corpus = Corpus(name=name)
         if session is not None:
             session.add(corpus)
         if self.max_docs is not None:
             pb = ProgressBar(self.max_docs)
-        for i, (doc, text) in enumerate(self.doc_parser.parse()):
+        for i, (doc, _) in enumerate(self._parse_docs(parallelism)):
             if self.max_docs is not None:
                 pb.bar(i)
-                if i == self.max_docs:
-                    break
             corpus.append(doc)
-            for _ in self.sent_parser.parse(doc, text):
-                pass
         if self.max_docs is not None:
             pb.bar(self.max_docs)
             pb.close()
@@ -47,6 +70,72 @@ class CorpusParser:
         corpus.stats()
         return corpus
 
+    def _parse_docs(self, parallelism, skip_names=frozenset()):
+        """Yields (Document, list of Sentences) pairs for up to max_docs documents not named in skip_names"""
+        docs = ((doc, text) for doc, text in islice(self.doc_parser.parse(), self.max_docs)
+                if doc.name not in skip_names)
+        if parallelism > 1:
+            for doc, sents in self.sent_parser.parse_docs(docs, parallelism=parallelism):
+                yield doc, sents
+        else:
+            for doc, text in docs:
+                yield doc, list(self.sent_parser.parse(doc, text))
+
+    def _parse_corpus_streaming(self, session, name, commit_every, parallelism):
+        corpus = session.query(Corpus).filter(Corpus.name == name).first()
+        if corpus is None:
+            corpus = Corpus(name=name)
+            session.add(corpus)
+            session.commit()
+
+        # Documents already in the corpus are skipped
+        q = select([Document.name]).select_from(Document.__table__.join(corpus_document_association))
+        q = q.where(corpus_document_association.c.corpus_id == corpus.id)
+        done = set(doc_name for doc_name, in session.execute(q))
+
+        if self.max_docs is not None:
+            pb = ProgressBar(self.max_docs)
+        batch = []
+        for i, (doc, sents) in enumerate(self._parse_docs(parallelism, skip_names=done)):
+            if self.max_docs is not None:
+                pb.bar(i)
+            batch.append((doc, sents))
+            if len(batch) == commit_every:
+                self._insert_documents(session, corpus, batch)
+                batch = []
+        self._insert_documents(session, corpus, batch)
+        if self.max_docs is not None:
+            pb.bar(self.max_docs)
+            pb.close()
+        session.expire(corpus)
+        corpus.stats()
+        return corpus
+
+    def _insert_documents(self, session, corpus, batch):
+        """Bulk inserts a batch of (Document, list of Sentences) pairs into the corpus and commits"""
+        if len(batch) == 0:
+            return
+        ids = iter(reserve_ids(session, Context.__table__, sum(1 + len(sents) for _, sents in batch)))
+        context_rows, doc_rows, sent_rows, assoc_rows = [], [], [], []
+        for doc, sents in batch:
+            doc_id = next(ids)
+            context_rows.append({'id': doc_id, 'type': 'document', 'stable_id': doc.stable_id})
+            doc_rows.append({'id': doc_id, 'name': doc.name, 'meta': doc.meta})
+            assoc_rows.append({'corpus_id': corpus.id, 'document_id': doc_id})
+            for sent in sents:
+                sent_id = next(ids)
+                context_rows.append({'id': sent_id, 'type': 'sentence', 'stable_id': sent.stable_id})
+                sent_row = dict((col, getattr(sent, col)) for col in SENTENCE_COLUMNS)
+                sent_row['id'] = sent_id
+                sent_row['document_id'] = doc_id
+                sent_rows.append(sent_row)
+        session.execute(Context.__table__.insert(), context_rows)
+        session.execute(Document.__table__.insert(), doc_rows)
+        if len(sent_rows) > 0:
+            session.execute(Sentence.__table__.insert(), sent_rows)
+        session.execute(corpus_document_association.insert(), assoc_rows)
+        session.commit()
+
 
 class DocParser:
     """Parse a file or directory of files into a set of Document objects."""
@@ -168,51 +257,194 @@ PTB = {'-RRB-': ')', '-LRB-': '(', '-RCB-': '}', '-LCB-': '{',
          '-RSB-': ']', '-LSB-': '['}
 
 class CoreNLPHandler:
-    def __init__(self, tok_whitespace=False):
+    """
+    Parses documents with one or more CoreNLP servers, launched on consecutive ports starting at port.
+
+    Each request goes to the server with the fewest requests in flight, skipping servers being restarted; if a
+    request fails, e.g. because the server died, the server is restarted and the request is retried once, on
+    another server if there is one. A request which gets no response within request_timeout seconds (None for
+    no limit), e.g. because the server hung, counts as failed; the default leaves the server SERVER_TIMEOUT
+    seconds to time out itself. Requests which time out on the server, e.g. for a pathological document, are
+    neither retried nor cause a restart.
+
+    If cache_dir is set, responses are cached on disk by document text, annotators, tokenizer options and CoreNLP
+    version (see ParseCache), and the servers are only launched once a document is not found in the cache.
+    """
+    def __init__(self, tok_whitespace=False, port=12345, num_servers=1, server_memory='4g', cache_dir=None,
+                 request_timeout=SERVER_TIMEOUT + 60):
         # http://stanfordnlp.github.io/CoreNLP/corenlp-server.html
         # Spawn a StanfordCoreNLPServer process that accepts parsing requests at an HTTP port.
         # Kill it when python exits.
         # This makes sure that we load the models only once.
         # In addition, it appears that StanfordCoreNLPServer loads only required models on demand.
         # So it doesn't load e.g. coref models and the total (on-demand) initialization takes only 7 sec.
-        self.port = 12345
+        self.port = port
+        self.ports = range(port, port + num_servers)
         self.tok_whitespace = tok_whitespace
-        loc = os.path.join(os.environ['SNORKELHOME'], 'parser')
-        cmd = ['java -Xmx4g -cp "%s/*" edu.stanford.nlp.pipeline.StanfordCoreNLPServer --port %d --timeout %d > /dev/null'
-               % (loc, self.port, 600000)]
-        self.server_pid = Popen(cmd, shell=True).pid
-        atexit.register(self._kill_pserver)
+        self.server_memory = server_memory
+        self.request_timeout = request_timeout
+        self.annotators = 'tokenize,ssplit,pos,lemma,depparse,ner'
         props = "\"tokenize.whitespace\": \"true\"," if self.tok_whitespace else ""
-        self.endpoint = 'http://127.0.0.1:%d/?properties={%s"annotators": "tokenize,ssplit,pos,lemma,depparse,ner", "outputFormat": "json"}' % (self.port, props)
+        self.endpoints = dict((p, 'http://127.0.0.1:%d/?properties={%s"annotators": "%s", "outputFormat": "json"}' % (p, props, self.annotators)) for p in self.ports)
+        self.endpoint = self.endpoints[port]
+
+        # Tracks the number of requests in flight per server, for load balancing, and the servers being restarted
+        self.lock = threading.Lock()
+        self.in_flight = dict((p, 0) for p in self.ports)
+        self.restarting = set()
+
+        # The servers are launched on the first request which is not served from the cache
+        self.servers = None
+        self.server_pid = None
+        atexit.register(self._kill_pserver)
+        if cache_dir is not None:
+            version = corenlp_version(os.path.join(os.environ['SNORKELHOME'], 'parser'))
+            self.cache = ParseCache(cache_dir, self.annotators, self.tok_whitespace, version)
+        else:
+            self.cache = None
 
         # Following enables retries to cope with CoreNLP server boot-up latency
         # See: http://stackoverflow.com/a/35504626
-        from requests.packages.urllib3.util.retry import Retry
-        from requests.adapters import HTTPAdapter
         self.requests_session = requests.Session()
-        retries = Retry(total=None,
-                        connect=20,
-                        read=0,
-                        backoff_factor=0.1,
-                        status_forcelist=[ 500, 502, 503, 504 ])
-        self.requests_session.mount('http://', HTTPAdapter(max_retries=retries))
-    
+        self.retries = Retry(total=None,
+                             connect=20,
+                             read=0,
+                             backoff_factor=0.1,
+                             status_forcelist=[ 500, 502, 503, 504 ])
+        self.requests_session.mount('http://', HTTPAdapter(max_retries=self.retries))
+
+    def _start_server(self, port):
+        """Launches a CoreNLP server on the port, returning its Popen object"""
+        loc = os.path.join(os.environ['SNORKELHOME'], 'parser')
+        cmd = ['exec java -Xmx%s -cp "%s/*" edu.stanford.nlp.pipeline.StanfordCoreNLPServer --port %d --timeout %d > /dev/null'
+               % (self.server_memory, loc, port, SERVER_TIMEOUT * 1000)]
+        return Popen(cmd, shell=True)
+
+    def _start_servers(self):
+        """Launches the CoreNLP servers, if not already running"""
+        with self.lock:
+            if self.servers is None:
+                self.servers = dict((p, self._start_server(p)) for p in self.ports)
+                if self.servers[self.port] is not None:
+                    self.server_pid = self.servers[self.port].pid
+
+    def _restart_server(self, port, server):
+        """
+        Kills the CoreNLP server process on the port, if still running, and launches a new one; does nothing
+        if it is already being restarted or has been replaced since server was read, e.g. by another thread.
+        The lock is only held to claim and swap the port's entry, so that requests to other servers proceed.
+        """
+        with self.lock:
+            if server is None or port in self.restarting or self.servers[port] is not server:
+                return
+            self.restarting.add(port)
+        try:
+            if server.poll() is None:
+                server.terminate()
+                server.wait()
+            sys.stderr.write('Restarting CoreNLP server on port %d...\n' % port)
+            new_server = self._start_server(port)
+        except:
+            with self.lock:
+                self.restarting.discard(port)
+            raise
+        with self.lock:
+            self.servers[port] = new_server
+            self.restarting.discard(port)
+            if port == self.port and new_server is not None:
+                self.server_pid = new_server.pid
+
     def _kill_pserver(self):
-        if self.server_pid is not None:
-            try:
-                os.kill(self.server_pid, signal.SIGTERM)
-            except:
-                sys.stderr.write('Could not kill CoreNLP server. Might already got killt...\n')
+        for server in (self.servers or {}).values():
+            if server is not None:
+                try:
+                    os.kill(server.pid, signal.SIGTERM)
+                except:
+                    sys.stderr.write('Could not kill CoreNLP server. Might already got killt...\n')
 
     def parse(self, document, text):
         """Parse a raw document as a string into a list of sentences"""
         if len(text.strip()) == 0:
             return
+        text, content = self._post(document, text)
+        for parts in self._parse_content(document, text, content):
+            yield parts
+
+    def parse_docs(self, docs, parallelism=1):
+        """
+        Parse an iterable of (document, raw text) pairs, yielding (document, list of sentences) pairs in the same
+        order, while keeping up to parallelism requests in flight against the server at once.
+
+        At most 2 * parallelism documents are parsed ahead of the consumer, so that memory stays bounded.
+        """
+        if parallelism > DEFAULT_POOLSIZE:
+            self.requests_session.mount('http://', HTTPAdapter(max_retries=self.retries, pool_maxsize=parallelism))
+        pool      = ThreadPool(parallelism)
+        in_flight = deque()
+        try:
+            for document, text in docs:
+                in_flight.append((document, pool.apply_async(self._parse_to_list, (document, text))))
+                if len(in_flight) >= 2 * parallelism:
+                    document, result = in_flight.popleft()
+                    yield document, result.get()
+            while len(in_flight) > 0:
+                document, result = in_flight.popleft()
+                yield document, result.get()
+        finally:
+            pool.terminate()
+
+    def _parse_to_list(self, document, text):
+        return list(self.parse(document, text))
+
+    def _post(self, document, text):
+        """Post a raw document to the server, returning the document as unicode and the response content"""
         if isinstance(text, unicode):
             text = text.encode('utf-8', 'error')
-        resp = self.requests_session.post(self.endpoint, data=text, allow_redirects=True)
-        text = text.decode('utf-8')
-        content = resp.content.strip()
+        if self.cache is not None:
+            key     = self.cache.key(text)
+            content = self.cache.get(key)
+            if content is not None:
+                return text.decode('utf-8'), content
+        self._start_servers()
+
+        # If the request fails, retry once, on another server if there is one
+        failed_port = None
+        for attempt in range(2):
+            with self.lock:
+                ports = [p for p in self.ports if p != failed_port] or self.ports
+                ports = [p for p in ports if p not in self.restarting] or ports
+                port  = min(ports, key=lambda p: self.in_flight[p])
+            try:
+                content = self._post_to_server(port, text)
+                break
+            except requests.exceptions.RequestException:
+                if attempt > 0:
+                    raise
+                failed_port = port
+
+        # Only cache complete responses, not errors, which may be transient
+        if self.cache is not None and content.startswith('{'):
+            self.cache.put(key, content)
+        return text.decode('utf-8'), content
+
+    def _post_to_server(self, port, text):
+        """Post to the server on the port, restarting it if the request fails or times out"""
+        with self.lock:
+            server = self.servers[port]
+            self.in_flight[port] += 1
+        try:
+            content = self.requests_session.post(self.endpoints[port], data=text, allow_redirects=True,
+                                                 timeout=self.request_timeout).content.strip()
+        except requests.exceptions.RequestException:
+            self._restart_server(port, server)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight[port] -= 1
+        return content
+
+    def _parse_content(self, document, text, content):
+        """Parse the content of a server response for a document into a list of sentences"""
         if content.startswith("Request is too long"):
             raise ValueError("File {} too long. Max character count is 100K.".format(document.name))
         if content.startswith("CoreNLP request timed out"):
@@ -268,10 +500,25 @@ class CoreNLPHandler:
 
 
 class SentenceParser(object):
-    def __init__(self, tok_whitespace=False):
-        self.corenlp_handler = CoreNLPHandler(tok_whitespace=tok_whitespace)
+    """
+    Parses documents into Sentences with CoreNLP; num_servers CoreNLP servers with server_memory each are
+    launched (see CoreNLPHandler)
+    """
+    def __init__(self, tok_whitespace=False, cache_dir=None, num_servers=1, server_memory='4g',
+                 request_timeout=SERVER_TIMEOUT + 60):
+        self.corenlp_handler = CoreNLPHandler(tok_whitespace=tok_whitespace, num_servers=num_servers,
+                                              server_memory=server_memory, cache_dir=cache_dir,
+                                              request_timeout=request_timeout)
 
     def parse(self, doc, text):
         """Parse a raw document as a string into a list of sentences"""
         for parts in self.corenlp_handler.parse(doc, text):
             yield Sentence(**parts)
+
+    def parse_docs(self, docs, parallelism=1):
+        """
+        Parse an iterable of (document, raw text) pairs, yielding (document, list of Sentences) pairs in the
+        same order, with up to parallelism documents being parsed concurrently
+        """
+        for doc, parts_list in self.corenlp_handler.parse_docs(docs, parallelism=parallelism):
+            yield doc, [Sentence(**parts) for parts in parts_list]
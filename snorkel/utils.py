@@ -1,7 +1,17 @@
 import re
 import sys
+import traceback
 import numpy as np
+from collections import OrderedDict
+from Queue import Empty
 import scipy.sparse as sparse
+from sqlalchemy.sql import func, select, text
+
+# Maximum number of parameters in a single IN (...) clause (SQLite allows at most 999 per statement)
+SQL_IN_BATCH_SIZE = 900
+
+# Seconds to wait for a result from worker processes before checking whether any of them exited unexpectedly
+QUEUE_COLLECT_TIMEOUT = 5
 
 
 class ProgressBar(object):
@@ -21,6 +31,94 @@ class ProgressBar(object):
         sys.stdout.flush()
 
 
+class LRUCache(object):
+    """A dict-like cache holding at most max_size entries, evicting the least recently used"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data     = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+        self.data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        self.data.clear()
+
+
+def start_workers(session, processes):
+    """
+    Starts the worker processes, after committing the session and disposing of the pooled connections of its
+    engine, so that no DB connection is shared with the workers after forking
+    """
+    session.commit()
+    session.get_bind().dispose()
+    for p in processes:
+        p.start()
+
+
+def run_worker(session, inputs, outputs, process):
+    """
+    Runs the body of a worker process with its own session: puts process(session, item) on the queue outputs for
+    each item taken from the queue inputs until None, expunging the session in between. Puts None when done, or
+    the traceback string on error (see collect_worker_results), and closes the session.
+    """
+    try:
+        for item in iter(inputs.get, None):
+            outputs.put(process(session, item))
+            session.expunge_all()
+    except Exception:
+        outputs.put(traceback.format_exc())
+    else:
+        outputs.put(None)
+    finally:
+        session.close()
+
+
+def collect_worker_results(processes, results, name):
+    """
+    Yields the results the worker processes put on the queue results, until each of them has put None when done;
+    raises a RuntimeError if one puts a traceback string instead, or exits unexpectedly. The processes are
+    terminated on any error, including in the consumer of the results, and otherwise joined once done.
+    """
+    n_active = len(processes)
+    try:
+        while n_active > 0:
+            try:
+                result = results.get(True, QUEUE_COLLECT_TIMEOUT)
+            except Empty:
+                if any(not p.is_alive() and p.exitcode != 0 for p in processes):
+                    raise RuntimeError('A %s exited unexpectedly.' % name)
+                continue
+            if result is None:
+                n_active -= 1
+            elif isinstance(result, basestring):
+                raise RuntimeError('Error in %s:\n%s' % (name, result))
+            else:
+                yield result
+    except:
+        for p in processes:
+            p.terminate()
+        raise
+    for p in processes:
+        p.join()
+
+
 def get_ORM_instance(ORM_class, session, instance):
     """
     Given an ORM class and *either an instance of this class, or the name attribute of an instance
@@ -112,3 +210,20 @@ def tokens_to_ngrams(tokens, n_max=3, delim=' '):
     for root in range(N):
         for n in range(min(n_max, N - root)):
             yield delim.join(tokens[root:root+n+1])
+
+
+def reserve_ids(session, table, n):
+    """
+    Returns a list of n unused integer primary key ids for the table, so that rows can be bulk inserted with
+    explicit ids instead of one INSERT per row to get each autoincremented id back.
+
+    NOTE: On Postgres, ids are drawn from the table's id sequence; on SQLite, they follow the current max id, so
+    the rows must be inserted before anything else writes to the table.
+    """
+    if n == 0:
+        return []
+    if session.get_bind().dialect.name == 'postgresql':
+        q = text("SELECT nextval('%s_id_seq') FROM generate_series(1, :n)" % table.name)
+        return [i for i, in session.execute(q, {'n': n})]
+    start = (session.execute(select([func.max(table.c.id)])).scalar() or 0) + 1
+    return range(start, start + n)
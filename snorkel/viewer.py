@@ -1,6 +1,8 @@
 from __future__ import print_function
-from .models import Label
+from .models import Candidate, CandidateSet, Label, load_candidates
 from .queries import get_or_create_single_key_set
+from .utils import SQL_IN_BATCH_SIZE
+from sqlalchemy.orm import Query
 try:
     from IPython.core.display import display, Javascript
 except:
@@ -49,7 +51,7 @@ class Viewer(widgets.DOMWidget):
         This AnnotationKeySet can be used to retrieve the labels with a LabelManager, and corresponding AnnotationKeys
         can be grouped into a new AnnotationKeySet to manage the work of multiple annotators simultaneously.
 
-        :param candidates: A Python container of Candidates (e.g., not a CandidateSet, but candidate_set.candidates)
+        :param candidates: A Python container of Candidates, a CandidateSet, or a query such as candidate_set.candidates
         :param session: The SnorkelSession for the database backend
         :param gold: Optional, Python container of Candidates that are know to have positive labels
         :param n_per_page: Optional, number of Contexts to display per page
@@ -77,6 +79,11 @@ class Viewer(widgets.DOMWidget):
         # Hence, we index by their position in this list
         # We get the sorted candidates and all contexts required, either from unary or binary candidates
         self.gold = list(gold)
+        if isinstance(candidates, CandidateSet):
+            candidates = candidates.iter_eager()
+        elif isinstance(candidates, Query):
+            # Loads the candidates along with their arguments and parent contexts up front (see load_candidates)
+            candidates = load_candidates(self.session, [cid for cid, in candidates.with_entities(Candidate.id)])
         self.candidates = sorted(list(candidates), key=lambda c : c[0].char_start)
         self.contexts   = list(set(c[0].parent for c in self.candidates + self.gold))
         
@@ -86,14 +93,18 @@ class Viewer(widgets.DOMWidget):
         except:
             pass
 
-        # Loads existing annotations
+        # Loads existing annotations, SQL_IN_BATCH_SIZE candidates at a time
         self.annotations = [None] * len(self.candidates)
         init_labels_serialized = []
+        cids = [c.id for c in self.candidates if c.id is not None]
+        existing_annotations = {}
+        for i in range(0, len(cids), SQL_IN_BATCH_SIZE):
+            for label in self.session.query(Label) \
+                    .filter(Label.key == self.annotator) \
+                    .filter(Label.candidate_id.in_(cids[i:i+SQL_IN_BATCH_SIZE])):
+                existing_annotations.setdefault(label.candidate_id, label)
         for i, candidate in enumerate(self.candidates):
-            existing_annotation = self.session.query(Label) \
-                .filter(Label.key == self.annotator) \
-                .filter(Label.candidate == candidate) \
-                .first()
+            existing_annotation = existing_annotations.get(candidate.id)
             if existing_annotation is not None:
                 self.annotations[i] = existing_annotation
                 if existing_annotation.value == 1:
@@ -0,0 +1,259 @@
+import os, sys, shutil, tempfile, unittest
+from uuid import uuid4
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from snorkel import SnorkelSession
+import snorkel.annotations
+from snorkel.annotations import FeatureManager, LabelManager, function_fingerprint
+from snorkel.candidates import CandidateExtractor, Ngrams
+from snorkel.matchers import DictionaryMatch
+from snorkel.models import AnnotationKey, CandidateSet, Corpus, Document, Label, Sentence, candidate_subclass, construct_stable_id
+
+TEXTS = ["Aspirin causes headache in some patients .", "Ibuprofen treats pain and fever quickly .",
+         "We found disease A/B in cow Alpha-3 ."]
+
+AnnotationTestPair = candidate_subclass('AnnotationTestPair', ['a', 'b'])
+
+
+def unique_name(prefix):
+    return '%s_%s' % (prefix, uuid4().hex)
+
+
+def create_corpus(session, n_docs):
+    """Creates a Corpus of n_docs Documents, each of the Sentences TEXTS, without parsing"""
+    corpus = Corpus(name=unique_name('corpus'))
+    for d in range(n_docs):
+        name = unique_name('doc')
+        doc  = Document(name=name, stable_id='%s::document:0:0' % name, meta={})
+        corpus.append(doc)
+        offset = 0
+        for position, text in enumerate(TEXTS):
+            words = text.split(' ')
+            char_offsets, o = [], 0
+            for w in words:
+                char_offsets.append(o)
+                o += len(w) + 1
+            Sentence(document=doc, position=position, text=text, words=words, char_offsets=char_offsets,
+                     lemmas=[w.lower() for w in words], pos_tags=['NN'] * len(words), ner_tags=['O'] * len(words),
+                     dep_parents=[0] * len(words), dep_labels=['dep'] * len(words),
+                     stable_id=construct_stable_id(doc, 'sentence', offset, offset + len(text)))
+            offset += len(text) + 1
+    session.add(corpus)
+    session.commit()
+    return corpus
+
+
+def extract_candidates(session, sentences):
+    """Extracts AnnotationTestPairs from the Sentences into a new CandidateSet"""
+    ce = CandidateExtractor(AnnotationTestPair, [Ngrams(n_max=2), Ngrams(n_max=2)],
+                            [DictionaryMatch(d=['aspirin', 'ibuprofen', 'found']),
+                             DictionaryMatch(d=['headache', 'pain', 'fever', 'cow'])])
+    return ce.extract(sentences, unique_name('candidates'), session)
+
+
+def lf_causes(c):
+    return 1 if 'causes' in c.a.parent.words else 0
+
+def lf_we(c):
+    return -1 if c.b.parent.words[0] == 'We' else 0
+
+def lf_offset(c):
+    return c.a.char_start % 3 - 1
+
+def lf_true(c):
+    return 1
+
+def lf_counted(c):
+    lf_counted.calls += 1
+    return 1 if c.b.get_span() == 'pain' else 0
+lf_counted.calls = 0
+
+def renamed(f, name):
+    f.__name__ = name
+    return f
+
+
+class TestAnnotationManager(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        corpus      = create_corpus(cls.session, 5)
+        cls.sents   = [s for doc in corpus for s in sorted(doc.sentences, key=lambda s: s.position)]
+
+    def setUp(self):
+        self.candidate_set = extract_candidates(self.session, self.sents)
+        self.key_set       = unique_name('lfs')
+        self.cache_dir     = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        lf_counted.__dict__.pop('version', None)
+
+    def assertMatrixEqual(self, A, B):
+        self.assertEqual(A.shape, B.shape)
+        self.assertEqual((A != B).nnz, 0)
+
+    def column(self, X, key_name):
+        """Returns the column of the annotation matrix X for the AnnotationKey named key_name"""
+        key = self.session.query(AnnotationKey).filter(AnnotationKey.name == key_name).one()
+        return X[:, X.get_col_index(key)]
+
+    def test_update_replaces_values(self):
+        lm = LabelManager()
+        L  = lm.create(self.session, self.candidate_set, self.key_set, f=[lf_causes, lf_we, lf_offset])
+        self.assertGreater(L.nnz, 0)
+
+        # Re-defines the functions under the same names, so that the same keys are annotated again, overwriting
+        # values both with other non-zero values and with zeros
+        lf_causes_negated = renamed(lambda c: -lf_causes(c), 'lf_causes')
+        lf_offset_zero    = renamed(lambda c: 0, 'lf_offset')
+        L2 = lm.update(self.session, self.candidate_set, self.key_set, True,
+                       f=[lf_causes_negated, lf_we, lf_offset_zero])
+        self.assertEqual(L2.shape, L.shape)
+        self.assertMatrixEqual(self.column(L2, 'lf_causes'), -self.column(L, 'lf_causes'))
+        self.assertMatrixEqual(self.column(L2, 'lf_we'), self.column(L, 'lf_we'))
+        self.assertEqual(self.column(L2, 'lf_offset').count_nonzero(), 0)
+
+        # Each (candidate, key) pair still has exactly one row
+        cids = [c.id for c in self.candidate_set]
+        n    = self.session.query(Label).filter(Label.candidate_id.in_(cids)).count()
+        m    = len(set(self.session.query(Label.candidate_id, Label.key_id).filter(Label.candidate_id.in_(cids))))
+        self.assertEqual(n, m)
+        self.assertMatrixEqual(lm.load(self.session, self.candidate_set, self.key_set), L2)
+
+    def test_parallel_equals_serial(self):
+        shard_size = snorkel.annotations.ANNOTATION_SHARD_SIZE
+        snorkel.annotations.ANNOTATION_SHARD_SIZE = 7
+        try:
+            for manager, f in [(LabelManager(), [lf_causes, lf_we, lf_offset]), (FeatureManager(), None)]:
+                X  = manager.create(self.session, self.candidate_set, unique_name('serial'), f=f)
+                X2 = manager.create(self.session, self.candidate_set, unique_name('parallel'), f=f, parallelism=3)
+                self.assertGreater(X.nnz, 0)
+                self.assertMatrixEqual(X2, X)
+                self.assertEqual(X2.col_index, X.col_index)
+                self.assertEqual(X2.row_index, X.row_index)
+        finally:
+            snorkel.annotations.ANNOTATION_SHARD_SIZE = shard_size
+
+    def test_function_fingerprint(self):
+        self.assertEqual(function_fingerprint(lf_offset), function_fingerprint(lf_offset))
+        self.assertEqual(function_fingerprint(lf_offset),
+                         function_fingerprint(renamed(lambda c: c.a.char_start % 3 - 1, 'f')))
+        self.assertNotEqual(function_fingerprint(lf_offset), function_fingerprint(lambda c: c.a.char_start % 3 + 1))
+        self.assertNotEqual(function_fingerprint(lf_offset), function_fingerprint(lambda c: c.a.char_end % 3 - 1))
+
+        # Changes of the globals and closures referenced change the fingerprint too, but not function attributes
+        fp = function_fingerprint(lf_counted)
+        lf_counted.calls += 1
+        self.assertEqual(function_fingerprint(lf_counted), fp)
+        global TEXTS
+        f  = lambda c: 1 if c.get_parent().text in TEXTS else 0
+        fp = function_fingerprint(f)
+        texts, TEXTS = TEXTS, TEXTS[:1]
+        try:
+            self.assertNotEqual(function_fingerprint(f), fp)
+        finally:
+            TEXTS = texts
+        self.assertEqual(function_fingerprint(f), fp)
+        lf_starts_at = lambda k: lambda c: 1 if c.a.char_start == k else 0
+        self.assertNotEqual(function_fingerprint(lf_starts_at(0)), function_fingerprint(lf_starts_at(1)))
+
+        # An explicit version overrides the hash
+        f, g = lambda c: 1, lambda c: -1
+        f.version = g.version = 2
+        self.assertEqual(function_fingerprint(f), function_fingerprint(g))
+        g.version = 3
+        self.assertNotEqual(function_fingerprint(f), function_fingerprint(g))
+
+    def test_incremental_update(self):
+        lm  = LabelManager(cache_dir=self.cache_dir)
+        lfs = [lf_causes, lf_offset, lf_counted]
+        L   = lm.create(self.session, self.candidate_set, self.key_set, f=lfs)
+        self.assertGreater(lf_counted.calls, 0)
+
+        # Unchanged functions are skipped
+        lf_counted.calls = 0
+        L2 = lm.update(self.session, self.candidate_set, self.key_set, True, f=lfs, incremental=True)
+        self.assertEqual(lf_counted.calls, 0)
+        self.assertMatrixEqual(L2, L)
+
+        # Functions with a changed body or constant are applied again, and only those
+        lfs = [renamed(lambda c: -lf_causes(c), 'lf_causes'), renamed(lambda c: c.a.char_start % 2, 'lf_offset'),
+               lf_counted]
+        L3 = lm.update(self.session, self.candidate_set, self.key_set, True, f=lfs, incremental=True)
+        self.assertEqual(lf_counted.calls, 0)
+        self.assertMatrixEqual(L3, LabelManager().load(self.session, self.candidate_set, self.key_set))
+        self.assertMatrixEqual(self.column(L3, 'lf_causes'), -self.column(L, 'lf_causes'))
+        self.assertGreater((self.column(L3, 'lf_offset') != self.column(L, 'lf_offset')).nnz, 0)
+
+        # An explicit version overrides the hash: the function is applied once more, when its fingerprint changes
+        # from the hash to the version, and then skipped, even though its body changed
+        lf_counted.version = 1
+        lm.update(self.session, self.candidate_set, self.key_set, True, f=lfs, incremental=True)
+        self.assertGreater(lf_counted.calls, 0)
+        lf_counted_negated = renamed(lambda c: -lf_counted(c), 'lf_counted')
+        lf_counted_negated.version, lf_counted.calls = 1, 0
+        L4 = lm.update(self.session, self.candidate_set, self.key_set, True, f=lfs[:2] + [lf_counted_negated],
+                       incremental=True)
+        self.assertEqual(lf_counted.calls, 0)
+        self.assertMatrixEqual(L4, L3)
+
+    def test_new_candidates_only(self):
+        # NOTE: lf_true labels every candidate, as those with only zero annotations would be annotated again
+        lfs = [lf_causes, lf_we, lf_true, lf_counted]
+        for cache_hit in [True, False]:
+            # NOTE: Annotations are shared by all key sets with the same keys, so fresh candidates are needed
+            corpus        = create_corpus(self.session, 4)
+            sents         = [s for doc in corpus for s in sorted(doc.sentences, key=lambda s: s.position)]
+            candidate_set = extract_candidates(self.session, sents[:6])
+            key_set       = unique_name('lfs')
+            lm            = LabelManager(cache_dir=self.cache_dir)
+            lm.create(self.session, candidate_set, key_set, f=lfs)
+            if not cache_hit:
+                lm.cache.clear()
+
+            # Extends the candidate set, and annotates only the new candidates
+            new_candidates = list(extract_candidates(self.session, sents[6:]))
+            for c in new_candidates:
+                candidate_set.append(c)
+            self.session.commit()
+            loads, load     = [], lm.load
+            lm.load         = lambda *args, **kwargs: loads.append(args) or load(*args, **kwargs)
+            lf_counted.calls = 0
+            L = lm.update(self.session, candidate_set, key_set, True, f=lfs, new_candidates_only=True)
+            self.assertEqual(lf_counted.calls, len(new_candidates))
+            self.assertEqual(len(loads), 0 if cache_hit else 1)
+
+            # The result, and the matrix loaded afterwards, equal a full recompute
+            L_full = LabelManager().create(self.session, candidate_set, unique_name('full'), f=lfs)
+            self.assertMatrixEqual(L, L_full)
+            self.assertEqual(L.row_index, L_full.row_index)
+            self.assertEqual(L.col_index, L_full.col_index)
+            self.assertMatrixEqual(load(self.session, candidate_set, key_set), L_full)
+
+    def test_cache_detects_swapped_candidates(self):
+        # The set leaves out its second candidate, which is then swapped in for the first, so that neither its size
+        # nor its max candidate id change
+        candidates    = sorted(self.candidate_set, key=lambda c: c.id)
+        candidate_set = CandidateSet(name=unique_name('swapped'))
+        candidate_set.candidates = [candidates[0]] + candidates[2:]
+        self.session.add(candidate_set)
+        self.session.commit()
+        lm  = LabelManager(cache_dir=self.cache_dir)
+        lfs = [lf_causes, lf_counted]
+        lm.create(self.session, candidate_set, self.key_set, f=lfs)
+        candidate_set.candidates.remove(candidates[0])
+        candidate_set.candidates.append(candidates[1])
+        self.session.commit()
+
+        # Neither the cached matrix nor the record of the functions applied are used
+        L = lm.load(self.session, candidate_set, self.key_set)
+        self.assertEqual(sorted(L.row_index.values()), [c.id for c in [candidates[1]] + candidates[2:]])
+        self.assertMatrixEqual(L, LabelManager().load(self.session, candidate_set, self.key_set))
+        lf_counted.calls = 0
+        lm.update(self.session, candidate_set, self.key_set, True, f=lfs, incremental=True)
+        self.assertEqual(lf_counted.calls, len(candidates) - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
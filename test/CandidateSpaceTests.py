@@ -1,7 +1,12 @@
-import os, sys, unittest, cPickle
+import os, re, sys, unittest, cPickle
 from time import sleep
+from uuid import uuid4
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from snorkel import SnorkelSession
+import snorkel.candidates
 from snorkel.candidates import *
+from snorkel.matchers import DictionaryMatch, Union
+from snorkel.models import Corpus, Document, Sentence, candidate_subclass, construct_stable_id
 from snorkel.parser import SentenceParser
 
 DATA_PATH = os.environ['SNORKELHOME'] + '/test/data/'
@@ -33,5 +38,146 @@ class TestCandidateSpace(unittest.TestCase):
         self.assertEqual(len(ngs), 25)
 
 
+class TestNgramsSplitTokens(unittest.TestCase):
+
+    def test_split_token_parts(self):
+        text = "disease A/B in cow Alpha-3"
+        sent = Sentence(text=text, words=text.split(), char_offsets=[m.start() for m in re.finditer(r'\S+', text)])
+        ngs  = [text[s:e+1] for s, e in Ngrams(n_max=1).char_ranges(sent)]
+        for span in ['A/B', 'A', 'B', 'Alpha-3', 'Alpha', '3']:
+            self.assertEqual(ngs.count(span), 1)
+        self.assertEqual(len(ngs), 9)
+
+
+class TestTemporarySpanHash(unittest.TestCase):
+
+    def test_hash(self):
+        text  = "Drug X may cure lung cancer ."
+        sent  = Sentence(id=1, text=text, words=text.split(), char_offsets=[m.start() for m in re.finditer(r'\S+', text)])
+        spans = list(Ngrams(n_max=2).apply(sent))
+        self.assertEqual(set(spans), set(TemporarySpan(parent=sent, char_start=s.char_start, char_end=s.char_end)
+                                         for s in spans))
+
+        # The cached hash follows reassigned chars
+        span = TemporarySpan(parent=sent, char_start=0, char_end=3)
+        span.char_start, span.char_end = 5, 5
+        self.assertEqual(hash(span), hash(TemporarySpan(parent=sent, char_start=5, char_end=5)))
+        self.assertIn(span, set([TemporarySpan(parent=sent, char_start=5, char_end=5)]))
+
+        # The hash is not cached until the parent gets an id, on flush
+        unflushed = Sentence(text=text, words=text.split(), char_offsets=sent.char_offsets)
+        span      = TemporarySpan(parent=unflushed, char_start=0, char_end=3)
+        unflushed.id = 2
+        self.assertEqual(hash(span), hash(TemporarySpan(parent=unflushed, char_start=0, char_end=3)))
+
+
+class TestBatchNgrams(unittest.TestCase):
+
+    def test_batch_char_ranges(self):
+        texts = ["We found disease A/B in cow Alpha-3 .", "-/ a-b-c", "", "One"]
+        sents = []
+        for text in texts:
+            words   = text.split()
+            offsets = [m.start() for m in re.finditer(r'\S+', text)]
+            sents.append(Sentence(text=text, words=words, char_offsets=offsets))
+        for n_max in [1, 3]:
+            for split_tokens in [['-', '/'], None]:
+                ngrams = Ngrams(n_max=n_max, split_tokens=split_tokens)
+                idx, starts, ends = ngrams.batch_char_ranges(sents)
+                for i, sent in enumerate(sents):
+                    self.assertEqual(list(ngrams.char_ranges(sent)), zip(starts[idx == i], ends[idx == i]))
+
+    def test_extract_batch(self):
+        texts = ["Drug X may cure lung cancer .", "They cure lung disease A/B .", ""]
+        sents = [Sentence(id=i+1, text=text, words=text.split(), char_offsets=[m.start() for m in re.finditer(r'\S+', text)])
+                 for i, text in enumerate(texts)]
+        ngrams = Ngrams(n_max=3)
+        m      = DictionaryMatch(d=['cure', 'lung', 'B', 'lung cancer'])
+        ce     = CandidateExtractor(candidate_subclass('BatchTestPair', ['a', 'b']), [ngrams, ngrams], [m, m])
+
+        # Candidates extracted from a batch, with the n-grams of all its contexts generated at once, are the same
+        span_meta = {}
+        expected  = [args for sent in sents for args in ce._extract_span_args(sent, span_meta)]
+        self.assertEqual(ce._extract_batch_span_args(sents), (expected, span_meta))
+        self.assertEqual(ce.candidate_spaces[0]._prepared, {})
+
+        # N-grams of contexts not in the prepared batch are generated as usual
+        ngrams.prepare(sents[:1])
+        self.assertEqual(list(ngrams.char_ranges(sents[1])), list(Ngrams(n_max=3).char_ranges(sents[1])))
+
+
+class TestCandidateExtractorMemo(unittest.TestCase):
+
+    def test_matcher_reuse_outside_extractor(self):
+        texts = ["Drug X may cure lung cancer .", "They cure lung disease ."]
+        sents = [Sentence(id=i+1, text=text, words=text.split(), char_offsets=[m.start() for m in re.finditer(r'\S+', text)])
+                 for i, text in enumerate(texts)]
+        ngrams = Ngrams(n_max=2)
+        m      = Union(DictionaryMatch(d=['cure']), DictionaryMatch(d=['lung']))
+        Pair   = candidate_subclass('MemoTestPair', ['a', 'b'])
+        ce     = CandidateExtractor(Pair, [ngrams, ngrams], [m, m])
+
+        # Both arguments get the same matches as the matcher alone
+        ce._match_child_contexts(sents[0])
+        expected = set(c.get_span() for c in m.apply(ngrams.apply(sents[0])))
+        self.assertEqual(set(c.get_span() for c in ce.child_context_sets[0]), expected)
+        self.assertEqual(set(c.get_span() for c in ce.child_context_sets[1]), expected)
+
+        # The memo does not outlive extraction, e.g. for the same char ranges of another sentence
+        self.assertEqual([c.get_span() for c in m.apply(ngrams.apply(sents[1]))], ['cure', 'lung'])
+        lung = DictionaryMatch(d=['lung'])
+        ce   = CandidateExtractor(Pair, [ngrams, ngrams], [lung, lung])
+        ce._match_child_contexts(sents[0])
+        self.assertEqual([c.get_span() for c in lung.apply(ngrams.apply(sents[1]))], ['lung'])
+
+
+def create_corpus(session, texts, n_docs):
+    """Creates a Corpus of n_docs Documents, each of the Sentences texts, without parsing"""
+    corpus = Corpus(name='corpus_%s' % uuid4().hex)
+    for d in range(n_docs):
+        name = 'doc%d_%s' % (d, uuid4().hex)
+        doc  = Document(name=name, stable_id='%s::document:0:0' % name, meta={})
+        corpus.append(doc)
+        offset = 0
+        for position, text in enumerate(texts):
+            Sentence(document=doc, position=position, text=text, words=text.split(),
+                     char_offsets=[m.start() for m in re.finditer(r'\S+', text)],
+                     stable_id=construct_stable_id(doc, 'sentence', offset, offset + len(text)))
+            offset += len(text) + 1
+    session.add(corpus)
+    session.commit()
+    return corpus
+
+
+class TestParallelExtraction(unittest.TestCase):
+
+    def test_parallel_equals_serial(self):
+        texts   = ["Drug X may cure lung cancer .", "They cure lung disease A/B .", "Nothing here ."]
+        session = SnorkelSession()
+        Pair    = candidate_subclass('ParallelTestPair', ['a', 'b'])
+        ngrams  = Ngrams(n_max=3)
+        ce      = CandidateExtractor(Pair, [ngrams, ngrams], [DictionaryMatch(d=['cure', 'B']),
+                                                             DictionaryMatch(d=['lung', 'lung cancer', 'A'])])
+
+        # Candidates are extracted from separate, identical corpora, as existing candidates would be reused
+        def extract(parallelism):
+            corpus = create_corpus(session, texts, 5)
+            docs   = dict((doc.id, i) for i, doc in enumerate(sorted(corpus.documents, key=lambda d: d.name)))
+            sents  = [sent for doc in corpus.documents for sent in doc.sentences]
+            cs     = ce.extract(sents, 'candidates_%s' % uuid4().hex, session, parallelism=parallelism)
+            return sorted((docs[c.a.parent.document_id], c.a.parent.position, c.a.char_start, c.a.char_end,
+                           c.b.char_start, c.b.char_end) for c in cs)
+
+        batch_size = snorkel.candidates.EXTRACTION_BATCH_SIZE
+        snorkel.candidates.EXTRACTION_BATCH_SIZE = 4
+        try:
+            serial = extract(False)
+            self.assertGreater(len(serial), 0)
+            self.assertEqual(extract(3), serial)
+        finally:
+            snorkel.candidates.EXTRACTION_BATCH_SIZE = batch_size
+        session.close()
+
+
 if __name__ == '__main__':
     unittest.main()
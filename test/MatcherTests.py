@@ -1,9 +1,11 @@
-import os, requests, sys, unittest, cPickle
+import os, random, re, requests, sys, unittest, cPickle
 from time import sleep
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import snorkel.matchers
 from snorkel.matchers import *
 from snorkel.parser import SentenceParser
 from snorkel.candidates import Ngrams
+from snorkel.models import Sentence
 
 DATA_PATH = os.environ['SNORKELHOME'] + '/test/data/'
 
@@ -59,5 +61,165 @@ class TestMatchers(unittest.TestCase):
         self.assertEqual(matches[0].get_span(), "Burritos and/or tacos")
 
 
+def make_sentence(text):
+    """Returns an unparsed Sentence of the text, tokenized on whitespace"""
+    return Sentence(id=1, text=text, words=text.split(), lemmas=text.lower().split(),
+                    char_offsets=[m.start() for m in re.finditer(r'\S+', text)])
+
+
+class TestMatcherEquivalence(unittest.TestCase):
+    """
+    Checks that the fast paths of matchers--DictionaryMatch(trie=True), memoized stemming, RegexMatchSpan(scan=True),
+    the literal prefilter of SlotFillMatch, Matcher.compile and longest-match suppression with a
+    SpanContainmentIndex--match the same candidates, in the same order, as the matchers they stand in for
+    """
+
+    def assertEquivalent(self, make_matcher, make_fast_matcher, text, ngrams_list, has_matches=True):
+        """
+        Asserts that matchers returned by make_matcher and make_fast_matcher have the same matches in the sentence
+        text for each of the candidate spaces ngrams_list; and that there are some, if has_matches is True, or none,
+        if it is False
+        """
+        sent = make_sentence(text)
+        for ngrams in ngrams_list:
+            matches = [c.get_span() for c in make_matcher().apply_context(ngrams, sent)]
+            if has_matches is not None:
+                self.assertEqual(len(matches) > 0, has_matches)
+            self.assertEqual([c.get_span() for c in make_fast_matcher().apply_context(ngrams, sent)], matches)
+
+    def test_dictionary_match_trie(self):
+        text   = "Aspirin-induced HEADACHE and renal failure , not renal cell failure ."
+        ngrams = [Ngrams(n_max=3), Ngrams(n_max=2, split_tokens=None)]
+        dicts  = [(['aspirin', 'headache', 'renal', 'renal failure', 'renal cell', 'failure .', 'induced'], True),
+                  # Empty dictionary
+                  ([], False),
+                  # Overlapping prefixes, of phrases and within tokens
+                  (['ren', 'renal', 'renal f', 'renal failure', 'renal failure ,', 'renal cell failure', 'aspirin-',
+                    'aspirin-induced'], True)]
+        for d, has_matches in dicts:
+            for opts in [{}, {'ignore_case': False}, {'longest_match_only': False}, {'attrib': 'lemmas'}]:
+                self.assertEquivalent(lambda: DictionaryMatch(d=d, **opts),
+                                      lambda: DictionaryMatch(d=d, trie=True, **opts), text, ngrams, has_matches)
+
+    def test_dictionary_match_trie_unsupported(self):
+        class Stemmer(object):
+            def stem(self, w):
+                return w[:4]
+        self.assertRaises(ValueError, DictionaryMatch, d=['renal'], trie=True, stemmer=Stemmer())
+        self.assertRaises(ValueError, DictionaryMatch, d=['renal'], trie=True, reverse=True)
+
+    def test_dictionary_match_stemming(self):
+        class Stemmer(object):
+            def __init__(self):
+                self.calls = []
+            def stem(self, w):
+                self.calls.append(w)
+                return re.sub(r'(s|ing|ure)$', '', w)
+
+        # Memoized stemming matches as stemming each phrase afresh, of whole phrases or token by token
+        text     = "Renal failure and failing kidneys , not renal cell failure ; renal failures ."
+        ngrams   = [Ngrams(n_max=3)]
+        d        = ['renal failure', 'kidney', 'fail', 'cells']
+        stem     = Stemmer().stem
+        whole    = frozenset(stem(w) for w in d)
+        by_token = frozenset(' '.join(stem(t) for t in w.split(' ')) for w in d)
+        stem_all = lambda p: ' '.join(stem(t) for t in p.split(' '))
+        self.assertEquivalent(lambda: LambdaFunctionMatch(func=lambda c: stem(c.get_span().lower()) in whole),
+                              lambda: DictionaryMatch(d=d, stemmer=Stemmer()), text, ngrams)
+        self.assertEquivalent(lambda: LambdaFunctionMatch(func=lambda c: stem_all(c.get_span().lower()) in by_token),
+                              lambda: DictionaryMatch(d=d, stemmer=Stemmer(), stem_tokens=True), text, ngrams)
+
+        # Each phrase, or token, is stemmed once, unless evicted from the memo
+        sent = make_sentence(text)
+        for stem_tokens in [False, True]:
+            stemmer = Stemmer()
+            m       = DictionaryMatch(d=d, stemmer=stemmer, stem_tokens=stem_tokens)
+            matches = list(m.apply_context(ngrams[0], sent))
+            self.assertEqual(len(stemmer.calls), len(set(stemmer.calls)))
+            cache_size = snorkel.matchers.STEM_CACHE_SIZE
+            snorkel.matchers.STEM_CACHE_SIZE = 3
+            try:
+                m = DictionaryMatch(d=d, stemmer=Stemmer(), stem_tokens=stem_tokens)
+                self.assertEqual(list(m.apply_context(ngrams[0], sent)), matches)
+                self.assertLessEqual(len(m._stem_cache), 3)
+            finally:
+                snorkel.matchers.STEM_CACHE_SIZE = cache_size
+
+        # A stemmer which leaves phrases unchanged matches as no stemmer
+        class NoStemmer(object):
+            def stem(self, w):
+                return w
+        for stem_tokens in [False, True]:
+            self.assertEquivalent(lambda: DictionaryMatch(d=d),
+                                  lambda: DictionaryMatch(d=d, stemmer=NoStemmer(), stem_tokens=stem_tokens),
+                                  text, ngrams)
+
+    def test_regex_match_span_scan(self):
+        text = "Take 500 mg of X-123 , or 20 mg twice daily ."
+        for rgx in [r'\d+ mg', r'\w+ \w+', r'\d{3}', r'[a-z]+\b']:
+            for opts in [{}, {'longest_match_only': False}, {'attrib': 'lemmas'}]:
+                self.assertEquivalent(lambda: RegexMatchSpan(rgx=rgx, **opts),
+                                      lambda: RegexMatchSpan(rgx=rgx, scan=True, **opts), text, [Ngrams(n_max=3)])
+
+        # Anchors and lookarounds, which scanning must not evaluate against the rest of the sentence, including
+        # for candidates starting within a token, e.g. 'g' of 'mg'
+        ngrams = [Ngrams(n_max=3), Ngrams(n_max=3, split_tokens=['-', 'm'])]
+        for rgx in [r'^\d+', r'\A\d+', r'\b\w+ mg', r'\bmg', r'\bg', r'\Bg', r'mg|\b\d+', r'(\bX)-\d+', r'(?<=of )\S+',
+                    r'(?<!\d )mg', r'(?=\d)\w+', r'(?!\d)\w+ \w+', r'\w+(?= mg)', r'\d+(?! mg)', r'mg\b', r'\w+\Z']:
+            self.assertEquivalent(lambda: RegexMatchSpan(rgx=rgx),
+                                  lambda: RegexMatchSpan(rgx=rgx, scan=True), text, ngrams, None)
+
+    def test_span_containment_index(self):
+        # The index agrees with a linear scan of all the spans added
+        rand  = random.Random(0)
+        index = SpanContainmentIndex()
+        seen  = []
+        for _ in range(1000):
+            s = rand.randint(0, 60)
+            e = s + rand.randint(0, 15)
+            self.assertEqual(index.contains(s, e), any(s >= s2 and e <= e2 for s2, e2 in seen))
+            if rand.random() < 0.3:
+                index.add(s, e)
+                seen.append((s, e))
+
+        # Longest-match suppression keeps the same candidates as the quadratic check of Matcher.apply, whatever
+        # the order of the candidates
+        text  = "Aspirin-induced HEADACHE and renal failure , not renal cell failure ."
+        cands = list(Ngrams(n_max=4).apply(make_sentence(text)))
+        for m in [DictionaryMatch(d=['aspirin', 'renal', 'renal failure', 'renal cell', 'cell failure', 'failure']),
+                  RegexMatchSpan(rgx=r'\w+ \w+'), LambdaFunctionMatch(func=lambda c: 'a' in c.get_span())]:
+            for _ in range(10):
+                rand.shuffle(cands)
+                matches = list(m.apply(cands))
+                self.assertGreater(len(matches), 0)
+                self.assertEqual(matches, list(Matcher.apply(m, cands)))
+
+    def test_slot_fill_match_prefilter(self):
+        class UnfilteredSlotFillMatch(SlotFillMatch):
+            def _prefilter(self, text):
+                return True
+        text = "Burritos and/or tacos , X-123 and Y-45 or tacos and burritos ( X-7 ) ."
+        dm   = lambda: DictionaryMatch(d=['burritos', 'tacos', 'x', 'y'])
+        rm   = lambda: RegexMatchSpan(rgx=r'\d+')
+        # Literal prefixes, suffixes and infixes, and splits with regex characters, which are not prefiltered
+        for pattern, children in [("{0} and/or {0}", [dm]), ("{0}-{1}", [dm, rm]), ("or {0}", [dm]),
+                                  ("{0} and", [dm]), ("X-{0} and Y-{1}", [rm, rm]), ("{0}.{1}", [dm, rm]),
+                                  ("{1} and {0}", [dm, dm]), (r"\( {0}-{1}", [dm, rm])]:
+            self.assertEquivalent(lambda: UnfilteredSlotFillMatch(*[c() for c in children], pattern=pattern),
+                                  lambda: SlotFillMatch(*[c() for c in children], pattern=pattern),
+                                  text, [Ngrams(n_max=5)])
+
+    def test_compile(self):
+        text = "Burritos and/or tacos cause acute renal failure , X-123 ."
+        dm   = lambda: DictionaryMatch(d=['burritos', 'tacos', 'acute', 'renal failure', 'x'])
+        lm   = lambda: LambdaFunctionMatch(func=lambda c: len(c.get_span()) > 4)
+        rm   = lambda: RegexMatchSpan(rgx=r'\d{3}')
+        for tree in [lambda: Concat(Union(lm(), dm()), dm()), lambda: Concat(dm(), dm(), permutations=True),
+                     lambda: SlotFillMatch(dm(), pattern="{0} and/or {0}"),
+                     lambda: SlotFillMatch(dm(), rm(), pattern="{0}-{1}"),
+                     lambda: DictionaryMatch(lm(), d=['acute renal failure', 'tacos'])]:
+            self.assertEquivalent(tree, lambda: tree().compile(), text, [Ngrams(n_max=4)])
+
+
 if __name__ == '__main__':
     unittest.main()
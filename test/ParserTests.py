@@ -1,7 +1,21 @@
 import os, requests, sys, unittest
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 import cPickle
+import random
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from requests.adapters import HTTPAdapter
+from uuid import uuid4
+from snorkel import SnorkelSession
+from snorkel.models import snorkel_postgres
 from snorkel.parser import *
+from sqlalchemy.sql import text
 
 ROOT = os.environ['SNORKELHOME']
 
@@ -37,5 +51,306 @@ class TestParsers(unittest.TestCase):
         self.assertEqual(corpus.get_docs(), gold_docs)
         self.assertEqual(corpus.get_contexts(), gold_sents)
 
+class StubCoreNLPRequestHandler(BaseHTTPRequestHandler):
+    """
+    Returns canned CoreNLP JSON for a single sentence of whitespace-separated tokens, after a random delay, or a
+    CoreNLP timeout message if the text contains TIMEOUT; hangs for a second without responding to text containing
+    SLEEP if server.hang is set; counts requests in server.n_requests
+    """
+    def do_POST(self):
+        text   = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        self.server.n_requests += 1
+        if 'TIMEOUT' in text:
+            self._respond('CoreNLP request timed out. Your document may be too long.')
+            return
+        if 'SLEEP' in text and self.server.hang:
+            time.sleep(1)
+            return
+        tokens, deps = [], []
+        matches = list(re.finditer(r'\S+', text))
+        for i, m in enumerate(matches):
+            after = text[m.end():matches[i+1].start()] if i < len(matches) - 1 else ''
+            tokens.append({'word': m.group(), 'originalText': m.group(), 'lemma': m.group().lower(), 'pos': 'NN',
+                           'ner': 'O', 'characterOffsetBegin': m.start(), 'characterOffsetEnd': m.end(),
+                           'after': after})
+            deps.append({'governor': 0, 'dep': 'ROOT' if i == 0 else 'dep', 'dependent': i + 1})
+        time.sleep(random.random() * 0.05)
+        self._respond(json.dumps({'sentences': [{'tokens': tokens, 'basic-dependencies': deps}]}))
+
+    def _respond(self, content):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubCoreNLPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    n_requests     = 0
+    hang           = False
+
+
+def start_stub_servers(n):
+    """Starts n StubCoreNLPServers on consecutive free ports"""
+    for port in range(20000, 40000, n):
+        servers = []
+        try:
+            for p in range(port, port + n):
+                servers.append(StubCoreNLPServer(('127.0.0.1', p), StubCoreNLPRequestHandler))
+        except socket.error:
+            for server in servers:
+                server.server_close()
+            continue
+        for server in servers:
+            threading.Thread(target=server.serve_forever).start()
+        return servers
+    raise Exception("No free ports found")
+
+
+class FakeServerProcess(object):
+    """Stands in for the Popen object of a CoreNLP server"""
+    pid = None
+
+    def __init__(self):
+        self.terminated = False
+
+    def poll(self):
+        return 0 if self.terminated else None
+
+    def terminate(self):
+        self.terminated = True
+
+    def wait(self):
+        return 0
+
+
+class StubCoreNLPHandler(CoreNLPHandler):
+    """A CoreNLPHandler which does not launch a CoreNLP server, for use with StubCoreNLPServer"""
+    def _start_server(self, port):
+        return None
+
+
+class FakeServerCoreNLPHandler(CoreNLPHandler):
+    """A CoreNLPHandler which launches FakeServerProcesses, and does not retry failed connections"""
+    def __init__(self, *args, **kwargs):
+        CoreNLPHandler.__init__(self, *args, **kwargs)
+        self.requests_session.mount('http://', HTTPAdapter(max_retries=0))
+
+    def _start_server(self, port):
+        return FakeServerProcess()
+
+    def _kill_pserver(self):
+        pass
+
+
+class TestCoreNLPServerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = start_stub_servers(2)
+        self.ports   = [server.server_address[1] for server in self.servers]
+        self.handler = FakeServerCoreNLPHandler(port=self.ports[0], num_servers=2)
+        self.doc     = Document(name='doc', stable_id='doc::document:0:0')
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_least_loaded_dispatch(self):
+        self.handler._start_servers()
+        self.handler.in_flight[self.ports[0]] = 100
+        for i in range(5):
+            self.assertEqual(len(list(self.handler.parse(self.doc, u'Document %d' % i))), 1)
+        self.assertEqual([server.n_requests for server in self.servers], [0, 5])
+        self.handler.in_flight[self.ports[0]] = 0
+        list(self.handler.parse_docs([(self.doc, u'Document %d' % i) for i in range(20)], parallelism=4))
+        self.assertTrue(all(server.n_requests > 5 for server in self.servers))
+
+    def test_restart_on_failure(self):
+        self.handler._start_servers()
+        dead = self.handler.servers[self.ports[1]]
+        self.servers[1].shutdown()
+        self.servers[1].server_close()
+        self.handler.in_flight[self.ports[0]] = 1
+        sents = list(self.handler.parse(self.doc, u'Failed over'))
+        self.assertEqual(sents[0]['words'], [u'Failed', u'over'])
+        self.assertTrue(dead.terminated)
+        self.assertIsNot(self.handler.servers[self.ports[1]], dead)
+        self.assertEqual(self.handler.restarting, set())
+        self.assertEqual(self.servers[0].n_requests, 1)
+
+    def test_no_restart_on_timeout(self):
+        self.handler._start_servers()
+        servers = dict(self.handler.servers)
+        self.assertRaises(ValueError, list, self.handler.parse(self.doc, u'TIMEOUT please'))
+        self.assertEqual(self.handler.servers, servers)
+        self.assertFalse(any(server.terminated for server in servers.values()))
+        self.assertEqual(sum(server.n_requests for server in self.servers), 1)
+
+    def test_restart_on_hung_server(self):
+        self.handler = FakeServerCoreNLPHandler(port=self.ports[0], num_servers=2, request_timeout=0.2)
+        self.handler._start_servers()
+        hung = self.handler.servers[self.ports[0]]
+        self.servers[0].hang = True
+        self.handler.in_flight[self.ports[1]] = 1
+        sents = list(self.handler.parse(self.doc, u'SLEEP then retry'))
+        self.assertEqual(sents[0]['words'], [u'SLEEP', u'then', u'retry'])
+        self.assertTrue(hung.terminated)
+        self.assertIsNot(self.handler.servers[self.ports[0]], hung)
+        self.assertEqual([server.n_requests for server in self.servers], [1, 1])
+
+
+class TestCoreNLPPipeline(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StubCoreNLPServer(('127.0.0.1', 0), StubCoreNLPRequestHandler)
+        threading.Thread(target=cls.server.serve_forever).start()
+        cls.handler = StubCoreNLPHandler(port=cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_parse_docs_preserves_order(self):
+        docs = [(Document(name='doc%d' % i, stable_id='doc%d::document:0:0' % i), u'Document number %d .' % i)
+                for i in range(50)]
+        parsed = list(self.handler.parse_docs(iter(docs), parallelism=8))
+        self.assertEqual([doc.name for doc, _ in parsed], [doc.name for doc, _ in docs])
+        for i, (doc, sents) in enumerate(parsed):
+            self.assertEqual(len(sents), 1)
+            self.assertEqual(sents[0]['words'], [u'Document', u'number', unicode(i), u'.'])
+            self.assertEqual(sents[0]['stable_id'], construct_stable_id(doc, 'sentence', 0, len(sents[0]['text'])))
+
+    def test_parse_docs_matches_parse(self):
+        docs = [(Document(name='doc%d' % i, stable_id='doc%d::document:0:0' % i), u'Another  doc\t%d' % i)
+                for i in range(10)]
+        parsed = list(self.handler.parse_docs(docs, parallelism=3))
+        for (doc, text), (_, sents) in zip(docs, parsed):
+            self.assertEqual(list(self.handler.parse(doc, text)), sents)
+
+    def test_parse_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            docs = [(Document(name='doc%d' % i, stable_id='doc%d::document:0:0' % i), u'Cached doc %d' % i)
+                    for i in range(10)]
+            handler = StubCoreNLPHandler(port=self.server.server_address[1], cache_dir=cache_dir)
+            parsed  = list(handler.parse_docs(docs, parallelism=3))
+
+            # A second pass should be served entirely from the cache, without launching any server
+            class NoServerHandler(CoreNLPHandler):
+                def _start_server(self, port):
+                    raise Exception("Server launched on a cache hit")
+            handler = NoServerHandler(port=self.server.server_address[1], cache_dir=cache_dir)
+            self.assertEqual(list(handler.parse_docs(docs, parallelism=3)), parsed)
+
+            # Changing the tokenizer options should miss the cache
+            handler = NoServerHandler(port=self.server.server_address[1], tok_whitespace=True, cache_dir=cache_dir)
+            self.assertRaises(Exception, list, handler.parse(*docs[0]))
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class StubDocParser(object):
+    """Yields documents of two sentences each, with the given names"""
+    def __init__(self, names):
+        self.names = names
+
+    def parse(self):
+        for name in self.names:
+            yield Document(name=name, stable_id='%s::document:0:0' % name), u'%s one . %s two .' % (name, name)
+
+
+class StubSentenceParser(object):
+    """Splits documents into sentences on periods, raising an exception on the document named crash_on"""
+    def __init__(self, crash_on=None):
+        self.crash_on = crash_on
+        self.parsed   = []
+
+    def parse(self, doc, text):
+        if doc.name == self.crash_on:
+            raise Exception("Parser crashed")
+        self.parsed.append(doc.name)
+        for position, m in enumerate(re.finditer(r'[^.]+\.', text)):
+            words = m.group().split()
+            yield Sentence(position=position, text=m.group(), words=words, lemmas=words,
+                           char_offsets=[w.start() for w in re.finditer(r'\S+', m.group())],
+                           stable_id=construct_stable_id(doc, 'sentence', m.start(), m.end()))
+
+
+class TestStreamingCorpusParser(unittest.TestCase):
+
+    def test_resume_after_crash(self):
+        session = SnorkelSession()
+        name    = 'streaming_%s' % uuid4().hex
+        names   = ['%s_doc%d' % (name, i) for i in range(10)]
+
+        # The crash loses the uncommitted batch, doc6 only, while doc7 is being parsed
+        sent_parser = StubSentenceParser(crash_on=names[7])
+        cp = CorpusParser(StubDocParser(names), sent_parser)
+        self.assertRaises(Exception, cp.parse_corpus, session, name, commit_every=3)
+        self.assertEqual(sent_parser.parsed, names[:7])
+        corpus = session.query(Corpus).filter(Corpus.name == name).one()
+        self.assertEqual(sorted(doc.name for doc in corpus.documents), names[:6])
+
+        # Resuming only parses the documents which were not committed
+        sent_parser = StubSentenceParser()
+        corpus = CorpusParser(StubDocParser(names), sent_parser).parse_corpus(session, name, commit_every=3)
+        self.assertEqual(sent_parser.parsed, names[6:])
+
+        # No document or sentence was inserted twice
+        docs = session.query(Document).filter(Document.name.in_(names)).all()
+        self.assertEqual(sorted(doc.name for doc in docs), names)
+        self.assertEqual(sorted(doc.name for doc in corpus.documents), names)
+        sents = session.query(Sentence).filter(Sentence.document_id.in_([doc.id for doc in docs])).all()
+        self.assertEqual(len(sents), 2 * len(names))
+        self.assertEqual(len(set(sent.stable_id for sent in sents)), len(sents))
+        for doc in docs:
+            self.assertEqual([sent.text for sent in sorted(doc.sentences, key=lambda s: s.position)],
+                             [u'%s one .' % doc.name, u' %s two .' % doc.name])
+        session.close()
+
+
+@unittest.skipIf(snorkel_postgres, "Sentence arrays are stored as ARRAYs on PostgreSQL")
+class TestPickledSentenceArrays(unittest.TestCase):
+
+    def test_read_pickled_row(self):
+        """Sentence arrays pickled by PickleType, as previously stored on SQLite, are read by IntArray and StringArray"""
+        session = SnorkelSession()
+        name    = 'pickled_%s' % uuid4().hex
+        doc     = Document(name=name, stable_id='%s::document:0:0' % name)
+        session.add(doc)
+        session.commit()
+        ids = reserve_ids(session, Context.__table__, 1)
+        row = {'id': ids[0], 'document_id': doc.id, 'position': 0, 'text': u'Old  row', 'words': [u'Old', u'row'],
+               'char_offsets': [0, 5], 'lemmas': [u'old', u'r\xf6w'], 'pos_tags': [], 'ner_tags': [u'', u'O'],
+               'dep_parents': [0, -1], 'dep_labels': None}
+        session.execute(Context.__table__.insert(), {'id': row['id'], 'type': 'sentence',
+                                                     'stable_id': '%s::sentence:0:8' % name})
+        pickled = dict((k, buffer(cPickle.dumps(v, 2)) if isinstance(v, list) else v) for k, v in row.items())
+        session.execute(text('INSERT INTO sentence (%s) VALUES (%s)'
+                             % (', '.join(row), ', '.join(':' + k for k in row))), pickled)
+        session.commit()
+        session.expunge_all()
+
+        sent = session.query(Sentence).filter(Sentence.id == row['id']).one()
+        for col in SENTENCE_COLUMNS:
+            if col != 'stable_id':
+                self.assertEqual(getattr(sent, col), row[col])
+
+        # Values written back are stored in the new encoding
+        sent.words = sent.words + [u'again']
+        session.commit()
+        session.expunge_all()
+        sent = session.query(Sentence).filter(Sentence.id == row['id']).one()
+        self.assertEqual(sent.words, [u'Old', u'row', u'again'])
+        session.close()
+
+
 if __name__ == '__main__':
     unittest.main()